@@ -0,0 +1,142 @@
+import fcntl
+import logging
+import selectors
+import socket
+import termios
+import time
+
+from threading import Event
+
+
+class BridgeException(Exception):
+    pass
+
+
+class SocketSerial(object):
+    """
+    Presents an accepted TCP connection with the subset of the
+    serial.Serial interface the receivers use, so _getc/_putc read the
+    socket directly instead of going through socat and a pty
+    """
+
+    def __init__(self, sock, timeout=None, write_timeout=None):
+        self._sock = sock
+        self._sock.setblocking(False)
+        self._sel = selectors.DefaultSelector()
+        self._sel.register(self._sock, selectors.EVENT_READ)
+        self._open = True
+
+        self.timeout = timeout
+        self.write_timeout = write_timeout
+
+    @property
+    def is_open(self):
+        return self._open
+
+    @property
+    def in_waiting(self):
+        if not self._open:
+            return 0
+        buf = bytearray(4)
+        fcntl.ioctl(self._sock.fileno(), termios.FIONREAD, buf)
+        return int.from_bytes(buf, "little")
+
+    def read(self, size=1):
+        buf = bytearray(size)
+        view = memoryview(buf)
+        got = 0
+        deadline = None if self.timeout is None \
+            else time.monotonic() + self.timeout
+
+        while self._open and got < size:
+            try:
+                n = self._sock.recv_into(view[got:])
+            except BlockingIOError:
+                wait = None if deadline is None \
+                    else deadline - time.monotonic()
+                if wait is not None and wait <= 0:
+                    break
+                self._sel.select(wait)
+                continue
+
+            if not n:
+                logging.info("Remote end closed the connection")
+                self.close()
+                break
+            got += n
+
+        return bytes(view[:got])
+
+    def write(self, data):
+        if not self._open:
+            raise BridgeException("Connection is closed")
+        self._sock.setblocking(True)
+        self._sock.settimeout(self.write_timeout)
+        try:
+            self._sock.sendall(data)
+        finally:
+            self._sock.setblocking(False)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def reset_input_buffer(self):
+        while self.in_waiting:
+            self._sock.recv(self.in_waiting)
+
+    flushInput = reset_input_buffer
+
+    def close(self):
+        if self._open:
+            self._open = False
+            self._sel.close()
+            self._sock.close()
+
+
+class TcpBridge(object):
+    """
+    Terminates TCP connections for a receiver, handing each accepted
+    connection over as a SocketSerial. The ready event is set once the
+    port is listening
+    """
+
+    def __init__(self, port, timeout=None, write_timeout=None):
+        self._port = port
+        self._timeout = timeout
+        self._write_timeout = write_timeout
+        self._srv = None
+        self._ready = Event()
+
+    def start(self):
+        self._srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._srv.bind(('', self._port))
+        self._srv.listen(1)
+        self._ready.set()
+        return self
+
+    def accept(self, cls=SocketSerial):
+        if not self._ready.is_set():
+            raise BridgeException("Bridge on {} is not listening".format(self._port))
+
+        sock, addr = self._srv.accept()
+        logging.info("Bridge connected by {}".format(addr))
+
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        except (AttributeError, OSError):
+            pass
+
+        return cls(sock, timeout=self._timeout, write_timeout=self._write_timeout)
+
+    def close(self):
+        self._ready.clear()
+        if self._srv is not None:
+            self._srv.close()
+            self._srv = None
+
+    @property
+    def ready(self):
+        return self._ready
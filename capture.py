@@ -0,0 +1,151 @@
+import logging
+import mmap
+import struct
+import time
+
+from collections import deque
+from threading import Event, Lock, Thread
+
+# A capture is the header, then a record for every read and write: the
+# time it happened, the direction, the length, then the bytes themselves
+MAGIC = b"WCAP"
+VERSION = 1
+HEADER = struct.Struct("=4sB")
+RECORD = struct.Struct("=dBI")
+
+READ = ord("R")
+WRITE = ord("W")
+
+
+class WireCapture(object):
+    """
+    Records the bytes crossing a line into a capture file. Records are
+    kept in memory and written out every flush_interval seconds by a
+    thread of its own, so recording costs a struct pack and an append. If
+    the disk falls behind by more than buffer_size bytes the oldest
+    records are dropped rather than holding up the line
+    """
+
+    def __init__(self, path, buffer_size=1048576, flush_interval=1.0):
+        self._fh = open(path, "wb")
+        self._fh.write(HEADER.pack(MAGIC, VERSION))
+        self._path = path
+        self._buffer_size = buffer_size
+        self._flush_interval = flush_interval
+        self._records = deque()
+        self._buffered = 0
+        self._dropped = 0
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def record(self, direction, data):
+        if not data:
+            return
+        record = RECORD.pack(time.time(), direction, len(data)) + data
+
+        with self._lock:
+            self._records.append(record)
+            self._buffered += len(record)
+            while self._buffered > self._buffer_size and \
+                    len(self._records) > 1:
+                self._buffered -= len(self._records.popleft())
+                self._dropped += 1
+
+    def _run(self):
+        while not self._stop.wait(self._flush_interval):
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            records = self._records
+            dropped = self._dropped
+            self._records = deque()
+            self._buffered = 0
+            self._dropped = 0
+
+        if dropped:
+            logging.warning("Capture to {} fell behind, dropped {} "
+                            "records".format(self._path, dropped))
+        if records and not self._fh.closed:
+            self._fh.write(b"".join(records))
+            self._fh.flush()
+
+    def close(self):
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+        self._fh.close()
+
+
+class CaptureConnection(object):
+    """
+    Wraps a serial connection, or anything that looks like one, recording
+    what is read from and written to it. Everything else passes through
+    """
+
+    def __init__(self, connection, capture):
+        self._connection = connection
+        self._capture = capture
+
+    def read(self, size=1):
+        data = self._connection.read(size)
+        self._capture.record(READ, data)
+        return data
+
+    def read_until(self, *args, **kwargs):
+        data = self._connection.read_until(*args, **kwargs)
+        self._capture.record(READ, data)
+        return data
+
+    def write(self, data):
+        size = self._connection.write(data)
+        self._capture.record(WRITE, data)
+        return size
+
+    def close(self):
+        try:
+            self._connection.close()
+        finally:
+            self._capture.close()
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def __setattr__(self, name, value):
+        if name.startswith("_"):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._connection, name, value)
+
+
+def read_capture(path):
+    """
+    (time, direction, data) for each record in a capture file, with data
+    a memoryview into the mapped file
+    """
+    with open(path, "rb") as fh:
+        try:
+            view = memoryview(mmap.mmap(fh.fileno(), 0,
+                                        access=mmap.ACCESS_READ))
+        except ValueError:
+            # An empty file can't be mapped
+            return
+
+    if len(view) < HEADER.size or \
+            HEADER.unpack_from(view)[0] != MAGIC:
+        raise CaptureException("{} isn't a capture".format(path))
+
+    offset = HEADER.size
+    while offset + RECORD.size <= len(view):
+        (when, direction, length) = RECORD.unpack_from(view, offset)
+        offset += RECORD.size
+        yield when, direction, view[offset:offset + length]
+        offset += length
+
+
+class CaptureException(Exception):
+    pass
@@ -0,0 +1,131 @@
+import logging
+import lzma
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+CODEC_ZSTD = 3
+
+CODECS = {
+    "none": CODEC_NONE,
+    "zlib": CODEC_ZLIB,
+    "lzma": CODEC_LZMA,
+    "zstd": CODEC_ZSTD,
+}
+
+
+def available():
+    codecs = [CODEC_NONE, CODEC_ZLIB, CODEC_LZMA]
+    if zstandard is not None:
+        codecs.append(CODEC_ZSTD)
+    return codecs
+
+
+def compressor(codec):
+    if codec == CODEC_ZLIB:
+        return zlib.compressobj(9)
+    elif codec == CODEC_LZMA:
+        return lzma.LZMACompressor(preset=6)
+    elif codec == CODEC_ZSTD and zstandard is not None:
+        return zstandard.ZstdCompressor(level=19).compressobj()
+    raise CompressionException("Codec {} is not available".format(codec))
+
+
+def decompressor(codec):
+    if codec == CODEC_ZLIB:
+        return zlib.decompressobj()
+    elif codec == CODEC_LZMA:
+        return lzma.LZMADecompressor()
+    elif codec == CODEC_ZSTD and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise CompressionException("Codec {} is not available".format(codec))
+
+
+def choose_codec(path, allowed, sample_size=16384, threshold=0.9):
+    """
+    Picks a codec for a file from a sample of its start: nothing if it
+    doesn't compress, otherwise the strongest codec the receiver allows
+    """
+    with open(path, "rb") as fh:
+        sample = fh.read(sample_size)
+
+    if not sample:
+        return CODEC_NONE
+
+    ratio = len(zlib.compress(sample, 6)) / float(len(sample))
+    logging.debug("Sample of {} compresses to {:.2f}".format(path, ratio))
+
+    if ratio > threshold:
+        return CODEC_NONE
+
+    for codec in (CODEC_LZMA, CODEC_ZSTD, CODEC_ZLIB):
+        if codec in allowed and codec in available():
+            return codec
+    return CODEC_NONE
+
+
+class CompressingReader(object):
+    """File-like stage compressing another reader as it is consumed"""
+
+    def __init__(self, source, codec, block_size=65536):
+        self._source = source
+        self._compressor = compressor(codec)
+        self._block_size = block_size
+        self._buffer = bytearray()
+        self._eof = False
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            data = self._source.read(self._block_size)
+            if data:
+                self._buffer += self._compressor.compress(data)
+            else:
+                self._buffer += self._compressor.flush()
+                self._eof = True
+
+        if size < 0 or size > len(self._buffer):
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+class DecompressingWriter(object):
+    """
+    File-like stage decompressing into another file as blocks arrive.
+    Anything after the end of the compressed stream, such as XMODEM
+    padding, is dropped
+    """
+
+    def __init__(self, target, codec):
+        self._target = target
+        self._decompressor = decompressor(codec)
+        self.length = 0
+
+    def write(self, data):
+        if self._decompressor.eof:
+            return len(data)
+
+        out = self._decompressor.decompress(data)
+        self._target.write(out)
+        self.length += len(out)
+        return len(data)
+
+    def flush(self):
+        self._target.flush()
+
+    def finish(self):
+        if not self._decompressor.eof:
+            raise CompressionException("Compressed stream ended early")
+        self.flush()
+        return self.length
+
+
+class CompressionException(Exception):
+    pass
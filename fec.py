@@ -0,0 +1,120 @@
+import functools
+
+# Reed-Solomon erasure code over GF(2^8). Parity blocks are rows of a
+# Cauchy matrix, so any k of the k data and m parity blocks of a group
+# give back the data. Blocks are multiplied a whole block at a time with
+# bytes.translate and summed as integers, which keeps the per byte work
+# in C without needing numpy
+
+# x^8 + x^4 + x^3 + x^2 + 1
+POLY = 0x11d
+
+# Data and parity blocks of a group share the 256 field elements
+MAX_BLOCKS = 256
+
+EXP = [0] * 512
+LOG = [0] * 256
+
+_x = 1
+for _i in range(255):
+    EXP[_i] = _x
+    LOG[_x] = _i
+    _x <<= 1
+    if _x & 0x100:
+        _x ^= POLY
+for _i in range(255, 512):
+    EXP[_i] = EXP[_i - 255]
+
+
+def _mul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return EXP[LOG[a] + LOG[b]]
+
+
+def _inv(a):
+    if a == 0:
+        raise FECException("Zero has no inverse")
+    return EXP[255 - LOG[a]]
+
+
+@functools.lru_cache(maxsize=None)
+def _table(c):
+    return bytes(_mul(c, x) for x in range(256))
+
+
+def _combine(coefficients, blocks):
+    """Sum of the blocks, each multiplied by its coefficient"""
+    total = 0
+    for (c, block) in zip(coefficients, blocks):
+        if c == 1:
+            total ^= int.from_bytes(block, "little")
+        elif c:
+            total ^= int.from_bytes(block.translate(_table(c)), "little")
+    return total.to_bytes(len(blocks[0]), "little")
+
+
+def _row(k, index):
+    """Coefficients that give block index of a group from its k data blocks"""
+    if index < k:
+        return [1 if j == index else 0 for j in range(k)]
+    # index and j never meet, so index ^ j is never zero
+    return [_inv(index ^ j) for j in range(k)]
+
+
+def _invert(matrix):
+    size = len(matrix)
+    rows = [list(row) + [1 if i == j else 0 for j in range(size)]
+            for (i, row) in enumerate(matrix)]
+
+    for col in range(size):
+        pivot = next((r for r in range(col, size) if rows[r][col]), None)
+        if pivot is None:
+            raise FECException("Blocks don't determine the group")
+        (rows[col], rows[pivot]) = (rows[pivot], rows[col])
+
+        scale = _inv(rows[col][col])
+        rows[col] = [_mul(scale, v) for v in rows[col]]
+        for r in range(size):
+            if r != col and rows[r][col]:
+                factor = rows[r][col]
+                rows[r] = [v ^ _mul(factor, p)
+                           for (v, p) in zip(rows[r], rows[col])]
+
+    return [row[size:] for row in rows]
+
+
+def encode(blocks, count):
+    """count parity blocks for a group of equal length data blocks"""
+    k = len(blocks)
+    if k + count > MAX_BLOCKS:
+        raise FECException("Groups are limited to {} blocks".format(
+            MAX_BLOCKS))
+    return [_combine(_row(k, k + i), blocks) for i in range(count)]
+
+
+def decode(k, blocks):
+    """
+    The k data blocks of a group from any k of its blocks, given as
+    {index: block} where parity block i has index k + i
+    """
+    missing = [j for j in range(k) if j not in blocks]
+    if not missing:
+        return [blocks[j] for j in range(k)]
+    if len(blocks) < k:
+        raise FECException("Need {} blocks to repair the group, have {}".
+                           format(k, len(blocks)))
+
+    # Prefer the data blocks, leaving less to solve for
+    chosen = sorted(blocks)[:k]
+    inverse = _invert([_row(k, index) for index in chosen])
+    rows = [blocks[index] for index in chosen]
+
+    data = [blocks.get(j) for j in range(k)]
+    for j in missing:
+        data[j] = _combine(inverse[j], rows)
+    return data
+
+
+class FECException(Exception):
+    pass
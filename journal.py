@@ -0,0 +1,218 @@
+import logging
+import sqlite3
+import time
+
+from threading import Lock, Timer
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    mtime INTEGER NOT NULL,
+    file_length INTEGER NOT NULL,
+    total_chunks INTEGER NOT NULL,
+    complete INTEGER NOT NULL DEFAULT 0,
+    digest BLOB,
+    updated REAL NOT NULL,
+    UNIQUE (name, mtime, file_length, total_chunks)
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    file_id INTEGER NOT NULL REFERENCES files (id),
+    chunk INTEGER NOT NULL,
+    offset INTEGER,
+    length INTEGER NOT NULL,
+    crc INTEGER NOT NULL,
+    digest BLOB,
+    updated REAL NOT NULL,
+    PRIMARY KEY (file_id, chunk)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS files_complete ON files (complete);
+"""
+
+
+class Journal(object):
+    """
+    Record of the files and chunks committed at one end of a transfer, so
+    resume and dedup decisions survive a restart. A file is identified by
+    its name, length and chunk count, plus its modification time on the
+    sending side.
+
+    Writes are grouped into a transaction committed commit_interval
+    seconds after it begins, whether or not anything follows, or as soon
+    as a file completes, on flush or on close. The database runs in WAL
+    mode without a sync per commit. A crash can lose the last few
+    records, which only means those chunks are sent again
+    """
+
+    def __init__(self, path, commit_interval=1.0):
+        self._path = path
+        self._commit_interval = commit_interval
+        self._lock = Lock()
+        self._ids = {}
+        self._timer = None
+
+        self._db = sqlite3.connect(path, isolation_level=None,
+                                   check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+
+    def _write(self, sql, params):
+        if self._timer is None:
+            self._db.execute("BEGIN")
+            self._timer = Timer(self._commit_interval, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+        return self._db.execute(sql, params)
+
+    def _commit(self):
+        if self._timer is not None:
+            self._db.execute("COMMIT")
+            self._timer.cancel()
+            self._timer = None
+
+    def _file_id(self, name, file_length, total_chunks, mtime, create=True):
+        key = (name, mtime, file_length, total_chunks)
+        if key in self._ids:
+            return self._ids[key]
+
+        row = self._db.execute(
+            "SELECT id FROM files WHERE name = ? AND mtime = ? AND "
+            "file_length = ? AND total_chunks = ?", key).fetchone()
+        if row is None:
+            if not create:
+                return None
+            row = (self._write(
+                "INSERT INTO files (name, mtime, file_length, total_chunks, "
+                "updated) VALUES (?, ?, ?, ?, ?)",
+                key + (time.time(),)).lastrowid,)
+
+        self._ids[key] = row[0]
+        return row[0]
+
+    def commit_chunk(self, name, file_length, total_chunks, chunk, length,
+                     crc, offset=None, mtime=0, digest=None,
+                     file_digest=None):
+        with self._lock:
+            file_id = self._file_id(name, file_length, total_chunks, mtime)
+            self._write(
+                "INSERT OR REPLACE INTO chunks (file_id, chunk, offset, "
+                "length, crc, digest, updated) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (file_id, chunk, offset, length, crc, digest, time.time()))
+            if file_digest is not None:
+                self._write("UPDATE files SET digest = ? WHERE id = ?",
+                            (file_digest, file_id))
+
+    def chunks(self, name, file_length, total_chunks, mtime=0):
+        """{chunk: (length, crc)} for the chunks committed"""
+        with self._lock:
+            file_id = self._file_id(name, file_length, total_chunks, mtime,
+                                    create=False)
+            if file_id is None:
+                return {}
+            return {chunk: (length, crc) for (chunk, length, crc) in
+                    self._db.execute(
+                        "SELECT chunk, length, crc FROM chunks "
+                        "WHERE file_id = ?", (file_id,))}
+
+    def offsets(self, name, file_length, total_chunks, mtime=0):
+        """{chunk: offset}, None for chunks committed without one"""
+        with self._lock:
+            file_id = self._file_id(name, file_length, total_chunks, mtime,
+                                    create=False)
+            if file_id is None:
+                return {}
+            return dict(self._db.execute(
+                "SELECT chunk, offset FROM chunks WHERE file_id = ?",
+                (file_id,)))
+
+    def digests(self, name, file_length, total_chunks, mtime=0):
+        """(file digest, {chunk: digest}), None where there isn't one"""
+        with self._lock:
+            file_id = self._file_id(name, file_length, total_chunks, mtime,
+                                    create=False)
+            if file_id is None:
+                return None, {}
+            (digest,) = self._db.execute(
+                "SELECT digest FROM files WHERE id = ?",
+                (file_id,)).fetchone()
+            return digest, dict(self._db.execute(
+                "SELECT chunk, digest FROM chunks WHERE file_id = ?",
+                (file_id,)))
+
+    def forget(self, name, file_length, total_chunks, mtime=0, chunk=None):
+        """
+        Drops the chunks recorded for a file, or just the one given, so
+        they're taken again
+        """
+        with self._lock:
+            file_id = self._file_id(name, file_length, total_chunks, mtime,
+                                    create=False)
+            if file_id is None:
+                return
+            if chunk is None:
+                self._write("DELETE FROM chunks WHERE file_id = ?",
+                            (file_id,))
+            else:
+                self._write("DELETE FROM chunks WHERE file_id = ? AND "
+                            "chunk = ?", (file_id, chunk))
+            self._commit()
+
+    def chunk_count(self, name, file_length, total_chunks, mtime=0):
+        with self._lock:
+            file_id = self._file_id(name, file_length, total_chunks, mtime,
+                                    create=False)
+            if file_id is None:
+                return 0
+            return self._db.execute(
+                "SELECT COUNT(*) FROM chunks WHERE file_id = ?",
+                (file_id,)).fetchone()[0]
+
+    def complete(self, name, file_length, total_chunks, mtime=0):
+        with self._lock:
+            file_id = self._file_id(name, file_length, total_chunks, mtime)
+            self._write("UPDATE files SET complete = 1, updated = ? "
+                        "WHERE id = ?", (time.time(), file_id))
+            self._commit()
+
+    def reopen(self, name, file_length, total_chunks, mtime=0):
+        """A complete file is being received again"""
+        with self._lock:
+            file_id = self._file_id(name, file_length, total_chunks, mtime,
+                                    create=False)
+            if file_id is not None:
+                self._write("UPDATE files SET complete = 0, updated = ? "
+                            "WHERE id = ?", (time.time(), file_id))
+                self._commit()
+
+    def is_complete(self, name, file_length, total_chunks, mtime=0):
+        with self._lock:
+            file_id = self._file_id(name, file_length, total_chunks, mtime,
+                                    create=False)
+            if file_id is None:
+                return False
+            return bool(self._db.execute(
+                "SELECT complete FROM files WHERE id = ?",
+                (file_id,)).fetchone()[0])
+
+    def unfinished(self):
+        """
+        (name, file_length, total_chunks) of files with every chunk
+        committed that haven't been completed
+        """
+        with self._lock:
+            return self._db.execute(
+                "SELECT name, file_length, total_chunks FROM files "
+                "WHERE complete = 0 AND total_chunks = "
+                "(SELECT COUNT(*) FROM chunks WHERE file_id = files.id)"
+            ).fetchall()
+
+    def flush(self):
+        with self._lock:
+            self._commit()
+
+    def close(self):
+        with self._lock:
+            self._commit()
+            self._db.close()
+        logging.debug("Closed journal {}".format(self._path))
@@ -0,0 +1,122 @@
+import logging
+import math
+
+from window import MAX_WINDOW
+
+# Starting guesses at the chance of a byte being corrupted, and how many
+# seconds a call lasts, for each +CSQ signal level. Measurements take over
+# once there are some
+PRIOR_BYTE_ERRORS = {0: 1e-3, 1: 3e-4, 2: 1e-4, 3: 3e-5, 4: 1e-5, 5: 3e-6}
+PRIOR_CALL_SECONDS = {0: 30, 1: 60, 2: 120, 3: 300, 4: 900, 5: 1800}
+
+BLOCK_SIZES = (128, 1024)
+
+# Bytes each block costs on top of its data: the XMODEM header and CRC16,
+# or the sliding window frame header and CRC32
+XMODEM_OVERHEAD = 5
+WINDOW_OVERHEAD = 15
+
+# Below this chance of a 1K frame being lost, parity isn't worth sending
+# until losses show up
+PARITY_THRESHOLD = 0.01
+
+# How much of the error estimate survives each frame observed
+ERROR_DECAY = 0.99
+
+
+class LinkController(object):
+    """
+    Picks the block size, minimum FEC parity and chunk size for each
+    transfer from how the link has been behaving: the errors the
+    transfers report, calls dropping, and the signal level. The aim is the
+    most data delivered per minute of call
+    """
+
+    def __init__(self, rate, rtt=1.5, chunking=True, chunk_align=1024,
+                 max_chunk_size=1048576):
+        self._rate = float(rate)
+        self._rtt = rtt
+        self._chunking = chunking
+        self._chunk_align = chunk_align
+        self._max_chunk_size = max_chunk_size
+        self._level = None
+        self._byte_errors = PRIOR_BYTE_ERRORS[3]
+        self._sent = 0
+        self._drops = 0
+
+    def signal(self, level):
+        """A new signal reading, which moves the error estimate halfway"""
+        level = max(0, min(5, level))
+        if level != self._level:
+            # Halfway on a log scale, as the priors are
+            self._byte_errors = math.sqrt(self._byte_errors *
+                                          PRIOR_BYTE_ERRORS[level])
+            self._level = level
+            logging.debug("Signal level {}, byte error estimate {:.2e}".format(
+                level, self._byte_errors))
+
+    def transferred(self, length, block_size, success_count, error_count,
+                    windowed=False, rtt=None):
+        """Statistics from a transfer, as given to its callback"""
+        self._sent += length
+        if rtt:
+            self._rtt = rtt
+
+        frames = success_count + error_count
+        if not frames:
+            return
+
+        overhead = WINDOW_OVERHEAD if windowed else XMODEM_OVERHEAD
+        frame_errors = min(error_count / float(frames), 0.99)
+        byte_errors = 1 - (1 - frame_errors) ** (1.0 / (block_size + overhead))
+
+        decay = ERROR_DECAY ** frames
+        self._byte_errors = decay * self._byte_errors + \
+            (1 - decay) * byte_errors
+        logging.debug("{} of {} frames failed, byte error estimate "
+                      "{:.2e}".format(error_count, frames, self._byte_errors))
+
+    def dropped(self):
+        """The call was lost"""
+        self._drops += 1
+
+    def _efficiency(self, block_size, windowed):
+        # Only the block and its framing go over the line to be corrupted.
+        # Each window waits a round trip for its first block's answer,
+        # which XMODEM's window of one block always does, while a full
+        # sliding window keeps sending through it
+        frame = block_size + (WINDOW_OVERHEAD if windowed else
+                              XMODEM_OVERHEAD)
+        window = MAX_WINDOW if windowed else 1
+        wait = max(0, self._rate * self._rtt - (window - 1) * frame)
+        delivered = (1 - self._byte_errors) ** frame
+        return block_size * delivered / (frame + wait / window)
+
+    def block_size(self, windowed=False):
+        return max(BLOCK_SIZES,
+                   key=lambda size: self._efficiency(size, windowed))
+
+    @property
+    def min_parity(self):
+        frame_errors = 1 - (1 - self._byte_errors) ** \
+            (BLOCK_SIZES[-1] + WINDOW_OVERHEAD)
+        return 1 if frame_errors > PARITY_THRESHOLD else 0
+
+    @property
+    def chunk_size(self):
+        """
+        Balances the cost of a chunk's handshake against the data lost
+        when a call drops mid chunk (Young's checkpoint interval), from
+        the data sent per dropped call so far
+        """
+        if not self._chunking:
+            return 0
+
+        prior = self._rate * PRIOR_CALL_SECONDS[
+            3 if self._level is None else self._level]
+        between_drops = (self._sent + prior) / (self._drops + 1)
+        handshake = 2 * self._rate * self._rtt + 100
+
+        size = math.sqrt(2 * handshake * between_drops)
+        size = min(self._max_chunk_size, max(4 * self._chunk_align, size))
+        return int(size // self._chunk_align * self._chunk_align)
@@ -0,0 +1,209 @@
+import logging
+import re
+import time
+
+STATE_COMMAND = "command"
+STATE_DATA = "data"
+
+re_final = re.compile(r"""^(OK
+                         |ERROR
+                         |BUSY
+                         |NO\ DIALTONE
+                         |NO\ CARRIER
+                         |NO\ ANSWER
+                         |READY
+                         |CONNECT(?:\s+\d+)?)$""", re.X)
+re_signal = re.compile(r'^\+CSQ:(\d)', re.MULTILINE)
+re_indicator = re.compile(r'^\+CIEV:(\d),(\d)')
+
+
+class Modem(object):
+    """
+    Drives a Hayes style modem from the responses it sends back, so each
+    step finishes as soon as the modem answers. The only fixed wait is the
+    guard time of silence the modem needs either side of the escape
+    sequence
+    """
+
+    def __init__(self, connection, lineend="\r", guard_time=1.0):
+        self._connection = connection
+        self._lineend = lineend
+        self._guard_time = guard_time
+        self._buffer = bytearray()
+        self._last_write = 0
+        self._signal = None
+        self.state = STATE_COMMAND
+
+    def write(self, data):
+        """
+        Writes to the line, in either mode. Data mode writes need to come
+        through here too so the escape knows how long the line has been
+        quiet
+        """
+        size = self._connection.write(data)
+        self._last_write = time.monotonic()
+        return size
+
+    def _read_line(self, deadline):
+        """Next non-empty line from the modem, or None at the deadline"""
+        timeout = self._connection.timeout
+
+        try:
+            while True:
+                ends = [i for i in (self._buffer.find(b"\r"),
+                                    self._buffer.find(b"\n")) if i >= 0]
+                if ends:
+                    end = min(ends)
+                    line = bytes(self._buffer[:end]).strip()
+                    del self._buffer[:end + 1]
+                    if line:
+                        return line.decode("latin-1")
+                    continue
+
+                remaining = None if deadline is None \
+                    else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._connection.timeout = remaining
+                self._buffer += self._connection.read(
+                    self._connection.in_waiting or 1)
+        finally:
+            self._connection.timeout = timeout
+
+    def _unsolicited(self, line):
+        if line == "RING":
+            logging.info("Modem reports an incoming call")
+            return True
+
+        indicator = re_indicator.match(line)
+        if indicator:
+            if indicator.group(1) == "0":
+                self._signal = int(indicator.group(2))
+                logging.debug("Got signal level {}".format(self._signal))
+            return True
+        return False
+
+    def _result(self, line):
+        if line.startswith("CONNECT"):
+            self.state = STATE_DATA
+            # Anything after CONNECT is the remote end's, not ours
+            del self._buffer[:]
+        elif line == "NO CARRIER":
+            self.state = STATE_COMMAND
+
+    def command(self, cmd, timeout=60):
+        """
+        Sends an AT command, returning the response lines up to and
+        including the final result code
+        """
+        if self.state != STATE_COMMAND:
+            raise ModemException("Cannot send {} in {} mode".format(
+                cmd, self.state))
+
+        self.write("{}{}".format(cmd.strip(), self._lineend).encode("latin-1"))
+        logging.info('Message sent: "{}"'.format(cmd.strip()))
+
+        deadline = time.monotonic() + timeout
+        lines = []
+        while True:
+            line = self._read_line(deadline)
+            if line is None:
+                raise ModemException("No response to {}".format(cmd.strip()))
+            if self._unsolicited(line):
+                continue
+
+            lines.append(line)
+            if re_final.match(line):
+                logging.info('Response received: "{}"'.format(
+                    "\n".join(lines)))
+                self._result(line)
+                return lines
+
+    def signal(self, timeout=60):
+        response = "\n".join(self.command("AT+CSQ?", timeout))
+        level = re_signal.search(response)
+
+        if not level:
+            raise ModemException(
+                "Could not interpret signal from response: {}".format(
+                    response))
+        self._signal = int(level.group(1))
+        logging.debug("Got signal level {}".format(self._signal))
+        return self._signal
+
+    def wait_for_signal(self, minimum, timeout=None):
+        """
+        Returns once the signal is at least minimum, having the modem
+        report changes to us rather than polling it
+        """
+        if self.signal() >= minimum:
+            return self._signal
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self.command("AT+CIER=1,1")
+        try:
+            while self._signal < minimum:
+                line = self._read_line(deadline)
+                if line is None:
+                    raise ModemException(
+                        "Signal didn't reach {} within {} seconds".format(
+                            minimum, timeout))
+                self._unsolicited(line)
+        finally:
+            self.command("AT+CIER=0")
+        return self._signal
+
+    def dial(self, number, timeout=90):
+        lines = self.command("ATDT{}".format(number), timeout)
+        if self.state != STATE_DATA:
+            raise ModemException("Error opening call: {}".format(
+                "\n".join(lines)))
+
+    def escape(self, timeout=10):
+        """Back to command mode, keeping the call up"""
+        self._connection.flush()
+        wait = self._guard_time - (time.monotonic() - self._last_write)
+        if wait > 0:
+            time.sleep(wait)
+
+        self.write(b"+++")
+        logging.info("Escape sequence sent")
+
+        # The modem answers once it has seen the guard time after +++
+        deadline = time.monotonic() + self._guard_time + timeout
+        while True:
+            line = self._read_line(deadline)
+            if line is None:
+                raise ModemException(
+                    "Did not switch to command mode to end call")
+            if line in ("OK", "NO CARRIER"):
+                self.state = STATE_COMMAND
+                return
+
+    def reset(self):
+        """
+        Assume command mode after losing track of the modem, ending any
+        partial command line and throwing away whatever it answers
+        """
+        self.state = STATE_COMMAND
+        del self._buffer[:]
+
+        self.write(self._lineend.encode("latin-1"))
+        deadline = time.monotonic() + self._guard_time
+        while True:
+            line = self._read_line(deadline)
+            if line is None or re_final.match(line):
+                break
+        del self._buffer[:]
+
+    def hangup(self, timeout=30):
+        if self.state == STATE_DATA:
+            self.escape()
+
+        lines = self.command("ATH0", timeout)
+        if lines[-1] != "OK":
+            raise ModemException("Did not hang up the call")
+
+
+class ModemException(Exception):
+    pass
@@ -0,0 +1,99 @@
+import logging
+import math
+import time
+
+from collections import deque
+from contextlib import contextmanager
+from link import PRIOR_CALL_SECONDS
+from modem import ModemException
+from threading import Event, Lock, Thread
+
+
+class SignalMonitor(object):
+    """
+    Samples the signal every interval seconds while the modem is idle,
+    keeping the last history samples to predict the next while from.
+    Calls take the modem with busy(), which the sampling stays clear of
+    """
+
+    def __init__(self, driver, interval=60, history=120, half_life=300):
+        self._driver = driver
+        self._interval = interval
+        self._half_life = float(half_life)
+        self._samples = deque(maxlen=history)
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread = Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._sample()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            self._sample()
+
+    def _sample(self):
+        # A call has the modem, which says more about the signal than a
+        # sample would
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            level = self._driver.signal(timeout=10)
+        except ModemException as e:
+            logging.warning("Could not sample the signal: {}".format(e))
+            return
+        finally:
+            self._lock.release()
+        self.record(level)
+
+    def record(self, level):
+        self._samples.append((time.monotonic(), level))
+
+    @contextmanager
+    def busy(self):
+        """Keeps the sampling off the modem for the length of a call"""
+        with self._lock:
+            yield
+
+    def predicted(self):
+        """
+        Level expected over the next while, the samples weighted by age so
+        the last few minutes count most. None until there are samples
+        """
+        if not self._samples:
+            return None
+
+        now = time.monotonic()
+        total = 0.0
+        weights = 0.0
+        for (when, level) in self._samples:
+            weight = 0.5 ** ((now - when) / self._half_life)
+            total += weight * level
+            weights += weight
+        return total / weights
+
+    def ready(self, seconds, minimum=3):
+        """
+        Whether a call is worth making for a workload that takes seconds
+        at the line rate. The predicted level has to be one expected to
+        hold a call that long, and at least minimum. Beyond that it needn't
+        be better than the best seen lately, or a site that never gets
+        there would never send
+        """
+        level = self.predicted()
+        if level is None:
+            return True
+
+        needed = next((l for l in sorted(PRIOR_CALL_SECONDS)
+                       if l >= minimum and PRIOR_CALL_SECONDS[l] >= seconds),
+                      max(PRIOR_CALL_SECONDS))
+        needed = max(minimum, min(needed,
+                                  max(l for (_, l) in self._samples)))
+        logging.debug("Signal predicted at {:.1f}, {} needed for {} "
+                      "seconds".format(level, needed, int(math.ceil(seconds))))
+        return round(level) >= needed
@@ -0,0 +1,436 @@
+import binascii
+import hashlib
+import logging
+import struct
+
+from collections import namedtuple
+
+WAKE = 0x40
+WAKE_REPLY = 0x41
+VERDICT = 0x17
+PIPELINE = 0x18
+NEGOTIATE = 0x19
+LEAD = 0x1a
+TAIL = 0x1b
+FILENAME = 0x1c
+GOFORIT = 0x1d
+STARTXFER = 0x1e
+NAMERECV = 0x1f
+
+# Capabilities a sender offers after NEGOTIATE, receivers echo back the
+# ones they support after GOFORIT
+CAP_1K = 0x01
+CAP_WINDOW = 0x02
+CAP_COMPRESS = 0x04
+CAP_ZSTD = 0x08
+CAP_PIPELINE = 0x10
+CAP_INLINE = 0x20
+CAP_DIGEST = 0x40
+CAP_FEC = 0x80
+
+# Flags carried in the upper half of the preamble's filename CRC field
+PREAMBLE_RESUME = 0x0001
+PREAMBLE_CODEC_MASK = 0x000e
+PREAMBLE_CODEC_SHIFT = 1
+PREAMBLE_INLINE = 0x0010
+PREAMBLE_DIGEST = 0x0020
+PREAMBLE_RANGE = 0x0040
+
+# The preamble is the lead and filename length, the filename, then the
+# fixed fields: file length, chunk, total chunks, CRC and flags, and tail.
+# We only have single byte lengths, and don't escape the markers since the
+# length tells us where the fixed fields are
+PREAMBLE_HEAD = struct.Struct("=BB")
+PREAMBLE_BODY = struct.Struct("=qqqiB")
+
+# XMODEM pads the final block of a transfer with this byte
+PAD = b"\x1a"
+
+# With PREAMBLE_DIGEST the fixed fields are followed by the digest of the
+# chunk and of the whole file, which is the digest of its chunk digests in
+# order. The receiver answers each such transfer with a verdict: VERDICT,
+# the chunk and whether it matched, then a CRC32 of those so a late
+# acknowledgement from the transfer can't pass for one
+DIGEST_SIZE = 16
+DIGESTS = struct.Struct("={0}s{0}s".format(DIGEST_SIZE))
+VERDICT_FRAME = struct.Struct("=Bq?")
+VERDICT_CRC = struct.Struct("=I")
+
+# With PREAMBLE_RANGE the digests are followed by the offset and length of
+# the chunk in the file, so the receiver can write it straight into place.
+# Receivers that accept CAP_DIGEST take it as well
+CHUNK_RANGE = struct.Struct("=qq")
+
+# Small files can travel inside the preamble, flagged PREAMBLE_INLINE: the
+# fixed fields, and any digests and range, are followed by the data length and
+# CRC32, then the data. The receiver stores the file and answers NAMERECV,
+# with no transfer
+INLINE_HEADER = struct.Struct("=HI")
+INLINE_MAX = 0xffff
+
+# Reply to a resume query, following NAMERECV: lead and entry count, then
+# (chunk, length, crc32) for every chunk held, then the tail byte
+RESUME_HEADER = struct.Struct("=BH")
+RESUME_ENTRY = struct.Struct("=qqI")
+RESUME_TAIL = struct.Struct("=B")
+
+Wake = namedtuple("Wake", [])
+Filename = namedtuple("Filename", [])
+# A pipelined negotiation is followed straight away by the preamble, and
+# the transfer starts after it without waiting for STARTXFER
+Negotiate = namedtuple("Negotiate", ["caps", "pipelined"],
+                       defaults=[False])
+StartTransfer = namedtuple("StartTransfer", [])
+InvalidMessage = namedtuple("InvalidMessage", ["reason", "data"])
+
+
+class ChunkDigest(object):
+    """
+    Length, CRC32 and strong digest of chunk data as it goes past. Given
+    the chunk's length, exactly that much is taken and anything after it,
+    like XMODEM padding, isn't. Without one, trailing padding is left out,
+    only counting once something follows it, so both ends agree however
+    the final block was padded
+    """
+
+    def __init__(self, length=None):
+        self._crc = 0
+        self._length = 0
+        self._hash = hashlib.blake2b(digest_size=DIGEST_SIZE)
+        self._pad = 0
+        self._remaining = length
+
+    def _add(self, data):
+        self._crc = binascii.crc32(data, self._crc)
+        self._hash.update(data)
+        self._length += len(data)
+
+    def update(self, data):
+        if self._remaining is not None:
+            data = data[:self._remaining]
+            self._remaining -= len(data)
+            self._add(data)
+            return
+
+        end = len(bytes(data).rstrip(PAD))
+        if end:
+            if self._pad:
+                self._add(PAD * self._pad)
+            self._add(data[:end])
+            self._pad = len(data) - end
+        else:
+            self._pad += len(data)
+
+    @property
+    def digest(self):
+        """(length, crc32), as reported in a resume reply"""
+        return self._length, self._crc & 0xffffffff
+
+    @property
+    def strong(self):
+        return self._hash.digest()
+
+
+def file_digest(chunk_digests):
+    digest = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    for chunk_digest in chunk_digests:
+        digest.update(chunk_digest)
+    return digest.digest()
+
+
+class Preamble(namedtuple("Preamble", ["filename", "file_length", "chunk",
+                                       "total_chunks", "flags", "data",
+                                       "digest", "file_digest", "offset",
+                                       "length"],
+                           defaults=[None, None, None, None, None])):
+    __slots__ = ()
+
+    @property
+    def codec(self):
+        return (self.flags & PREAMBLE_CODEC_MASK) >> PREAMBLE_CODEC_SHIFT
+
+    @property
+    def resume_query(self):
+        # A resume query is sent as chunk 0, the receiver replies with the
+        # chunks it already holds and doesn't expect a transfer
+        return bool(self.flags & PREAMBLE_RESUME) and self.chunk == 0
+
+    @property
+    def inline(self):
+        return self.data is not None
+
+
+def pack_preamble(filename, file_length, chunk=1, total_chunks=1, flags=0,
+                  data=None, digests=None, chunk_range=None):
+    """
+    digests is (chunk digest, file digest) if they're to be checked, and
+    chunk_range the (offset, length) of the chunk in the file
+    """
+    filename = filename[:255]
+    if data is not None:
+        flags |= PREAMBLE_INLINE
+    if digests is not None:
+        flags |= PREAMBLE_DIGEST
+    if chunk_range is not None:
+        flags |= PREAMBLE_RANGE
+
+    buffer = PREAMBLE_HEAD.pack(LEAD, len(filename)) + filename + \
+        PREAMBLE_BODY.pack(file_length, chunk, total_chunks,
+                           binascii.crc32(filename) & 0xffff | flags << 16,
+                           TAIL)
+    if digests is not None:
+        buffer += DIGESTS.pack(*digests)
+    if chunk_range is not None:
+        buffer += CHUNK_RANGE.pack(*chunk_range)
+    if data is not None:
+        if len(data) > INLINE_MAX:
+            raise ProtocolException("{} bytes is too much to send "
+                                    "inline".format(len(data)))
+        buffer += INLINE_HEADER.pack(len(data),
+                                     binascii.crc32(data) & 0xffffffff) + data
+    return buffer
+
+
+def pack_pipelined(caps, preamble):
+    """
+    Capabilities, file details and the start of the transfer in a single
+    message, for receivers that accepted CAP_PIPELINE
+    """
+    return bytes([PIPELINE, caps]) + preamble
+
+
+def pack_verdict(chunk, verified):
+    frame = VERDICT_FRAME.pack(VERDICT, chunk, verified)
+    return frame + VERDICT_CRC.pack(binascii.crc32(frame) & 0xffffffff)
+
+
+def unpack_verdict(data):
+    """(chunk, verified), or None if data isn't a verdict"""
+    if len(data) != VERDICT_FRAME.size + VERDICT_CRC.size or \
+            data[0] != VERDICT:
+        return None
+
+    frame = data[:VERDICT_FRAME.size]
+    if VERDICT_CRC.unpack_from(data, VERDICT_FRAME.size)[0] != \
+            binascii.crc32(frame) & 0xffffffff:
+        return None
+    return VERDICT_FRAME.unpack(frame)[1:]
+
+
+def pack_resume(held):
+    buffer = bytearray(RESUME_HEADER.pack(LEAD, len(held)))
+    for chunk, (length, crc) in sorted(held.items()):
+        buffer += RESUME_ENTRY.pack(chunk, length, crc)
+    buffer += RESUME_TAIL.pack(TAIL)
+    return bytes(buffer)
+
+
+def unpack_resume(data):
+    """Chunks held from a resume reply, without the leading NAMERECV"""
+    if len(data) < RESUME_HEADER.size:
+        raise ProtocolException("Resume response is too short")
+
+    (lead, count) = RESUME_HEADER.unpack_from(data)
+    end = RESUME_HEADER.size + count * RESUME_ENTRY.size
+
+    if lead != LEAD or len(data) != end + RESUME_TAIL.size \
+            or RESUME_TAIL.unpack_from(data, end)[0] != TAIL:
+        raise ProtocolException("Invalid resume response received")
+
+    held = {}
+    for (chunk, length, crc) in RESUME_ENTRY.iter_unpack(
+            data[RESUME_HEADER.size:end]):
+        held[chunk] = (length, crc)
+    return held
+
+
+STATE_COMMAND = 0
+STATE_PREAMBLE = 1
+STATE_START = 2
+STATE_TRANSFER = 3
+
+
+class Parser(object):
+    """
+    Push parser for the handshake ahead of each transfer. Bytes are fed in
+    as they arrive, in pieces of any size, and complete messages come back
+    in order. After StartTransfer, or a pipelined preamble without inline
+    data, the parser stops, holding anything that followed for the
+    transfer (see take) until it's reset
+    """
+
+    def __init__(self, preamble=True):
+        self._preamble = preamble
+        self._buffer = bytearray()
+        self._state = STATE_COMMAND
+        self._pipelined = False
+
+    @property
+    def buffered(self):
+        return len(self._buffer)
+
+    @property
+    def transferring(self):
+        return self._state == STATE_TRANSFER
+
+    def reset(self):
+        """Go back to waiting for a command, keeping anything buffered"""
+        self._state = STATE_COMMAND
+
+    def take(self):
+        """Hand over the buffered bytes, for the transfer to start from"""
+        data = bytes(self._buffer)
+        del self._buffer[:]
+        return data
+
+    def feed(self, data):
+        self._buffer += data
+        messages = []
+
+        while self._state != STATE_TRANSFER:
+            if self._state == STATE_COMMAND:
+                message = self._command()
+            elif self._state == STATE_PREAMBLE:
+                message = self._preamble_message()
+            else:
+                message = self._start()
+
+            if message is None:
+                break
+            messages.append(message)
+        return messages
+
+    def _after_command(self):
+        self._state = STATE_PREAMBLE if self._preamble else STATE_TRANSFER
+
+    def _command(self):
+        buffer = self._buffer
+
+        while buffer:
+            byte = buffer[0]
+
+            if byte == WAKE:
+                del buffer[:1]
+                return Wake()
+            elif byte == FILENAME:
+                del buffer[:1]
+                self._pipelined = False
+                self._after_command()
+                return Filename()
+            elif byte in (NEGOTIATE, PIPELINE):
+                if len(buffer) < 2:
+                    return None
+                caps = buffer[1]
+                del buffer[:2]
+                self._pipelined = byte == PIPELINE
+                self._after_command()
+                return Negotiate(caps, self._pipelined)
+
+            del buffer[:1]
+        return None
+
+    def _preamble_message(self):
+        buffer = self._buffer
+
+        lead = buffer.find(LEAD)
+        # A sender that has given up on us starts again with the init byte
+        wake = buffer.find(WAKE, 0, len(buffer) if lead < 0 else lead)
+        if wake >= 0:
+            del buffer[:wake + 1]
+            self._state = STATE_COMMAND
+            return Wake()
+
+        if lead < 0:
+            if buffer:
+                logging.warning("Redundant characters received: {}".format(
+                    buffer.hex()))
+            del buffer[:]
+            return None
+        elif lead > 0:
+            logging.warning("Redundant characters received: {}".format(
+                buffer[:lead].hex()))
+            del buffer[:lead]
+
+        if len(buffer) < PREAMBLE_HEAD.size:
+            return None
+        length = buffer[1]
+        size = PREAMBLE_HEAD.size + length + PREAMBLE_BODY.size
+        if len(buffer) < size:
+            return None
+
+        # Digests, the range and inline data follow the fixed fields, so
+        # wait for all of them
+        flags = (PREAMBLE_BODY.unpack_from(
+            buffer, PREAMBLE_HEAD.size + length)[3] >> 16) & 0xffff
+        if flags & PREAMBLE_DIGEST:
+            size += DIGESTS.size
+        if flags & PREAMBLE_RANGE:
+            size += CHUNK_RANGE.size
+        if len(buffer) < size:
+            return None
+        if flags & PREAMBLE_INLINE:
+            if len(buffer) < size + INLINE_HEADER.size:
+                return None
+            size += INLINE_HEADER.size + \
+                INLINE_HEADER.unpack_from(buffer, size)[0]
+            if len(buffer) < size:
+                return None
+
+        data = bytes(buffer[:size])
+        del buffer[:size]
+
+        filename = data[PREAMBLE_HEAD.size:PREAMBLE_HEAD.size + length]
+        (file_length, chunk, total_chunks, crc32, tail) = \
+            PREAMBLE_BODY.unpack_from(data, PREAMBLE_HEAD.size + length)
+
+        self._state = STATE_COMMAND
+        if tail != TAIL or binascii.crc32(filename) & 0xffff != crc32 & 0xffff:
+            return InvalidMessage("Invalid filename information received",
+                                  data)
+
+        offset = PREAMBLE_HEAD.size + length + PREAMBLE_BODY.size
+        digests = (None, None)
+        if flags & PREAMBLE_DIGEST:
+            digests = DIGESTS.unpack_from(data, offset)
+            offset += DIGESTS.size
+
+        chunk_range = (None, None)
+        if flags & PREAMBLE_RANGE:
+            chunk_range = CHUNK_RANGE.unpack_from(data, offset)
+            offset += CHUNK_RANGE.size
+
+        inline = None
+        if flags & PREAMBLE_INLINE:
+            inline_crc = INLINE_HEADER.unpack_from(data, offset)[1]
+            inline = data[offset + INLINE_HEADER.size:]
+            if binascii.crc32(inline) & 0xffffffff != inline_crc:
+                return InvalidMessage("Inline data for {} failed its "
+                                      "checksum".format(filename), data)
+
+        preamble = Preamble(filename, file_length, chunk, total_chunks, flags,
+                            inline, *(digests + chunk_range))
+        if not preamble.resume_query and not preamble.inline:
+            self._state = STATE_TRANSFER if self._pipelined else STATE_START
+        return preamble
+
+    def _start(self):
+        buffer = self._buffer
+
+        start = buffer.find(STARTXFER)
+        wake = buffer.find(WAKE, 0, len(buffer) if start < 0 else start)
+        if wake >= 0:
+            del buffer[:wake + 1]
+            self._state = STATE_COMMAND
+            return Wake()
+
+        if start < 0:
+            del buffer[:]
+            return None
+
+        del buffer[:start + 1]
+        self._state = STATE_TRANSFER
+        return StartTransfer()
+
+
+class ProtocolException(Exception):
+    pass
@@ -1,35 +1,63 @@
 import argparse
-import binascii
+import asyncio
+import compression
+import itertools
 import logging
 import os
 import socket
-import struct
 import sys
-import time as tm
 import xmodem
 
+from compression import CODEC_ZSTD, CompressionException, \
+    DecompressingWriter
+from concurrent.futures import ThreadPoolExecutor
+from protocol import CAP_1K, CAP_COMPRESS, CAP_DIGEST, CAP_FEC, \
+    CAP_INLINE, CAP_PIPELINE, CAP_WINDOW, CAP_ZSTD, GOFORIT, NAMERECV, WAKE_REPLY, \
+    Filename, InvalidMessage, Negotiate, Parser, Preamble, Wake, \
+    pack_resume, pack_verdict
+from store import Assembler, ChunkStore, DigestWriter, StoreException
 from threading import Thread
+from window import SlidingWindow
 
-FILENAME = 0x1c
-GOFORIT = 0x1d
-STARTXFER = 0x1e
-NAMERECV = 0x1f
+# XMODEM-1K needs nothing from us as the xmodem receiver picks the block
+# size from each packet header
+CAPABILITIES = CAP_1K | CAP_WINDOW | CAP_COMPRESS | CAP_PIPELINE | \
+    CAP_INLINE | CAP_DIGEST | CAP_FEC | \
+    (CAP_ZSTD if CODEC_ZSTD in compression.available() else 0)
 
 
 # Based on https://github.com/pyserial/pyserial/
 # blob/master/examples/tcp_serial_redirect.py
 class DataReceiver(object):
-    def __init__(self, port, output_dir):
+    def __init__(self, port, output_dir, max_transfers=32, backlog=64,
+                 timeout=120, preamble_timeout=120):
         self._dir = output_dir
         self._port = port
+        self._timeout = timeout
+        self._preamble_timeout = preamble_timeout
 
         if not os.path.exists(self._dir):
             raise DataReceiverConfigurationError("{} doesn't exist".format(self._dir))
 
+        self._store = ChunkStore(self._dir)
+        self._assembler = Assembler(self._store)
+
+        # Pick up reassembly that was interrupted when we last stopped
+        for (filename, file_length, total_chunks) in \
+                self._store.unassembled():
+            self._assembler.submit(filename, file_length, total_chunks)
+
         self._srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self._srv.bind(('', self._port))
-        self._srv.listen(0)
+        self._srv.listen(backlog)
+
+        # The handshake for every connection runs on the event loop, but the
+        # xmodem library drives blocking getc/putc callbacks, so each active
+        # transfer gets a worker that is fed from the loop
+        self._loop = asyncio.new_event_loop()
+        self._xfer_pool = ThreadPoolExecutor(max_workers=max_transfers,
+                                             thread_name_prefix="xmodem")
 
         self._thread = Thread(target=self.run)
         self._thread.start()
@@ -37,200 +65,327 @@ class DataReceiver(object):
         self._intentional_exit = False
 
     def run(self):
-        try:
-            while True:
-                logging.info('Waiting for connection on {}...'.format(self._port))
-                client_socket, addr = self._srv.accept()
-                logging.info('Connected by {}'.format(addr))
-
-                # More quickly detect bad clients who quit without closing the
-                # connection: After 1 second of idle, start sending TCP keep-alive
-                # packets every 1 second. If 3 consecutive keep-alive packets
-                # fail, assume the client is gone and close the connection.
-                try:
-                    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 1)
-                    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 1)
-                    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
-                    client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-                    client_socket.setsockopt(socket.IPPROTO_TCP,
-                                             socket.TCP_NODELAY, 1)
-
-                    client_socket.setsockopt(socket.SOL_SOCKET,
-                                             socket.SO_RCVTIMEO,
-                                             (1).to_bytes(8, sys.byteorder) +
-                                             (0).to_bytes(8, sys.byteorder))
-                    x = client_socket.getsockopt(socket.SOL_SOCKET,
-                                                 socket.SO_RCVTIMEO,
-                                                 16)
-                    logging.info("Timeout seconds: {}, usecs: {}".format(
-                        int.from_bytes(x[:8], sys.byteorder),
-                        int.from_bytes(x[8:], sys.byteorder)))
-
-                except AttributeError:
-                    pass
-
-                data = bytearray()
-                lead_in = False
-                preamble = False
+        asyncio.set_event_loop(self._loop)
 
-                try:
-                    while True:
-                        try:
-                            recv = client_socket.recv(4096)
-                        except socket.error as e:
-                            if e.errno == 11:
-                                continue
-                            else:
-                                raise
-
-                        if not recv:
-                            continue
-                        else:
-                            data += recv
-
-                        logging.info("Buffer size received: {}".
-                                     format(len(data)))
-
-                        if not lead_in and not preamble \
-                                and data[-1] == int.from_bytes(b"@",
-                                                               sys.byteorder):
-                            logging.info("Got init byte, sending response")
-                            client_socket.send(b"A")
-                            data = bytearray()
-                            continue
-
-                        if not lead_in:
-                            if data == FILENAME.to_bytes(1, sys.byteorder):
-                                logging.debug("Sending FILENAME response...")
-                                client_socket.send(GOFORIT.to_bytes(1, sys.byteorder))
-                                data = bytearray()
-                                lead_in = True
-                            else:
-                                logging.debug("No valid message received, "
-                                              "start again...")
-                            continue
-
-                        if not preamble:
-                            logging.info("Waiting for filename information...")
-                            logging.debug("File message: {}".format(data))
-
-                            try:
-                                (lead, length) = struct.unpack_from("BB", data)
-
-                                req_length = \
-                                    struct.calcsize("=BB{}sqqqiB".format(
-                                        length))
-
-                                if len(data) != req_length:
-                                    logging.warning("{} is not equal to "
-                                                    "expected {} "
-                                                    "bytes".format(len(data),
-                                                                   req_length))
-                                    # TODO: limit retries?
-                                    continue
-
-                                (filename, file_length) = struct.unpack_from(
-                                    "{}sq".format(length),
-                                    data,
-                                    struct.calcsize("=BB"))
-                                (chunk, total_chunks) = struct.unpack_from(
-                                    "qq".format(length),
-                                    data,
-                                    struct.calcsize("=BB{}sq".format(length)))
-                                (crc32, tail) = struct.\
-                                    unpack_from("iB", data,
-                                                struct.calcsize("=BB{}sqqq".
-                                                                format(length)))
-                            except struct.error:
-                                continue
-
-                            logging.info("Received filename infromation, "
-                                         "checking...")
-                            logging.debug("Filename length: {}".format(length))
-                            logging.debug("File length: {}".format(file_length))
-                            logging.debug("Filename: {}".format(filename))
-                            logging.debug("Filename CRC: {}".format(crc32))
-
-                            if lead == 0x1a and tail == 0x1b \
-                               and binascii.crc32(filename) & 0xffff == crc32:
-                                client_socket.send(NAMERECV.to_bytes(1, sys.byteorder))
-
-                                with open("dataout.bin", "wb") as dataout:
-                                    def _getc(size, timeout=1):
-                                        try:
-                                            read = client_socket.recv(size)
-                                            dataout.write(read)
-                                        except socket.error as e:
-                                            if e.errno == 11:
-                                                read = None
-
-                                        logging.debug("READ {} DATA: {}".format(
-                                            size,
-                                            str(int.from_bytes(read,
-                                                               sys.byteorder))
-                                            if read else "none"))
-                                        return read or None
-
-                                    def _putc(msg, timeout=1):
-                                        logging.debug("WRITE DATA: {}".format(msg))
-                                        size = client_socket.send(msg)
-                                        return size
-
-                                    data = bytearray()
-
-                                    while not len(data) or \
-                                            data[-1] != STARTXFER:
-                                        try:
-                                            data += client_socket.recv(4096)
-                                        except socket.error as e:
-                                            if e.errno != 11:
-                                                raise
-
-                                    logging.warning("TEMP sleep for 5, "
-                                                    "sender should not start")
-                                    tm.sleep(5)
-
-                                    client_socket.setsockopt(socket.SOL_SOCKET,
-                                                             socket.SO_RCVTIMEO,
-                                                             (10).to_bytes(8,
-                                                                          sys.byteorder) +
-                                                             (0).to_bytes(8,
-                                                                          sys.byteorder))
-                                    x = client_socket.getsockopt(
-                                        socket.SOL_SOCKET,
-                                        socket.SO_RCVTIMEO,
-                                        16)
-                                    logging.info(
-                                        "Timeout seconds: {}, usecs: {}".format(
-                                            int.from_bytes(x[:8],
-                                                           sys.byteorder),
-                                            int.from_bytes(x[8:],
-                                                           sys.byteorder)))
-
-                                    xfer = xmodem.XMODEM(_getc, _putc)
-                                    with open(filename, "wb") as fh:
-                                        xfer.recv(fh)
-                            else:
-                                logging.warning("Invalid message received")
-                                break
-
-                        logging.info("Resetting flags and data buffer")
-                        data = bytearray()
-
-                        lead_in = False
-                        preamble = False
-
-
-                finally:
-                    logging.info('Disconnected')
-                    client_socket.close()
+        try:
+            self._loop.run_until_complete(self._serve())
         finally:
+            self._xfer_pool.shutdown(wait=False)
+            self._loop.close()
+
+    async def _serve(self):
+        server = await asyncio.start_server(self._handle_client, sock=self._srv)
+        logging.info('Waiting for connections on {}...'.format(self._port))
+
+        async with server:
+            await server.serve_forever()
+
+    async def _handle_client(self, reader, writer):
+        addr = writer.get_extra_info("peername")
+        logging.info('Connected by {}'.format(addr))
+
+        # More quickly detect bad clients who quit without closing the
+        # connection: After 1 second of idle, start sending TCP keep-alive
+        # packets every 1 second. If 3 consecutive keep-alive packets
+        # fail, assume the client is gone and close the connection.
+        client_socket = writer.get_extra_info("socket")
+        try:
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 1)
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 1)
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+            client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            client_socket.setsockopt(socket.IPPROTO_TCP,
+                                     socket.TCP_NODELAY, 1)
+        except AttributeError:
             pass
 
+        try:
+            await ClientConnection(self, reader, writer, addr).run()
+        except Exception:
+            logging.exception("Connection from {} failed".format(addr))
+        finally:
+            logging.info('Disconnected {}'.format(addr))
+            writer.close()
+
+    @property
+    def assembler(self):
+        return self._assembler
+
+    @property
+    def loop(self):
+        return self._loop
+
+    @property
+    def preamble_timeout(self):
+        return self._preamble_timeout
+
+    @property
+    def store(self):
+        return self._store
+
     @property
     def thread(self):
         return self._thread
 
+    @property
+    def timeout(self):
+        return self._timeout
+
+    @property
+    def xfer_pool(self):
+        return self._xfer_pool
+
+
+class ClientConnection(object):
+    """Protocol state for a single remote node connected to the receiver"""
+
+    # A node striping over several modems sends chunks of the same file
+    # over several connections, each receives into its own partial files
+    _tags = itertools.count(1)
+
+    def __init__(self, receiver, reader, writer, addr):
+        self._receiver = receiver
+        self._reader = reader
+        self._writer = writer
+        self._addr = addr
+        self._tag = next(self._tags)
+
+        self._parser = Parser()
+        self._preamble = None
+        self._caps = 0
+
+    def _send(self, msg):
+        self._writer.write(msg)
+
+    async def run(self):
+        loop = self._receiver.loop
+        deadline = None
+
+        while True:
+            # Idle connections wait on the event loop until the timeout, a
+            # message that has started has its own deadline to finish by
+            if deadline is None:
+                timeout = self._receiver.timeout
+            else:
+                timeout = max(0, deadline - loop.time())
+
+            try:
+                recv = await asyncio.wait_for(self._reader.read(4096),
+                                              timeout)
+            except asyncio.TimeoutError:
+                if deadline is None:
+                    logging.info("{} idle for {} seconds, disconnecting".
+                                 format(self._addr, self._receiver.timeout))
+                    break
+
+                logging.warning("Incomplete message from {} not finished "
+                                "within {} seconds, discarding {} bytes".
+                                format(self._addr,
+                                       self._receiver.preamble_timeout,
+                                       self._parser.buffered))
+                self._parser.take()
+                self._parser.reset()
+                deadline = None
+                continue
+
+            if not recv:
+                logging.info("{} closed the connection".format(self._addr))
+                break
+
+            logging.info("Buffer size received: {}".format(len(recv)))
+
+            for message in self._parser.feed(recv):
+                if not self._handle(message):
+                    return
+            await self._writer.drain()
+
+            if self._parser.transferring:
+                try:
+                    await self._receive_file(self._preamble)
+                except DataReceiverRuntimeError as e:
+                    logging.warning(e)
+                    break
+
+                logging.info("Resetting for the next transfer")
+                self._parser.reset()
+                self._preamble = None
+
+            if not self._parser.buffered:
+                deadline = None
+            elif deadline is None:
+                deadline = loop.time() + self._receiver.preamble_timeout
+
+    def _handle(self, message):
+        if isinstance(message, Wake):
+            logging.info("Got init byte, sending response")
+            self._send(WAKE_REPLY.to_bytes(1, sys.byteorder))
+        elif isinstance(message, Filename):
+            logging.debug("Sending FILENAME response...")
+            self._send(GOFORIT.to_bytes(1, sys.byteorder))
+            self._caps = 0
+        elif isinstance(message, Negotiate):
+            self._caps = message.caps & CAPABILITIES
+            logging.debug("Sending FILENAME response, accepting "
+                          "capabilities {:#04x}...".format(self._caps))
+            self._send(GOFORIT.to_bytes(1, sys.byteorder) +
+                       self._caps.to_bytes(1, sys.byteorder))
+        elif isinstance(message, Preamble):
+            logging.info("Received filename infromation, "
+                         "checking...")
+            logging.debug("File length: {}".format(message.file_length))
+            logging.debug("Filename: {}".format(message.filename))
+            logging.debug("Flags: {:#06x}".format(message.flags))
+
+            if message.codec not in compression.available():
+                logging.warning("Unsupported codec {} for {}".format(
+                    message.codec, message.filename))
+                return False
+
+            if message.resume_query:
+                held = self._receiver.store.held_chunks(
+                    message.filename, message.file_length,
+                    message.total_chunks, whole=message.file_digest)
+                self._send(NAMERECV.to_bytes(1, sys.byteorder) +
+                           pack_resume(held))
+            elif message.inline:
+                try:
+                    self._receiver.store.store_inline(
+                        message.filename, message.file_length, message.data)
+                except (OSError, StoreException) as e:
+                    logging.warning("Could not store {}: {}".format(
+                        message.filename, e))
+                    return False
+                self._send(NAMERECV.to_bytes(1, sys.byteorder))
+            else:
+                self._send(NAMERECV.to_bytes(1, sys.byteorder))
+                self._preamble = message
+        elif isinstance(message, InvalidMessage):
+            logging.warning(message.reason)
+            return False
+        return True
+
+    async def _receive_file(self, preamble):
+        store = self._receiver.store
+        try:
+            (received, digest) = await self._receiver.loop.run_in_executor(
+                self._receiver.xfer_pool, self._xmodem_recv, preamble,
+                self._parser.take())
+        except Exception:
+            self._discard(preamble)
+            raise
+        logging.info("Transfer of chunk {} of {} from {} finished: {}".format(
+            preamble.chunk, preamble.filename, self._addr, received))
+
+        # A sender that gave a digest waits to hear whether the chunk
+        # matched it, so it can send just this one again
+        verified = received is not None and \
+            preamble.digest in (None, digest.strong)
+        if preamble.digest is not None:
+            self._send(pack_verdict(preamble.chunk, verified))
+            await self._writer.drain()
+
+        if not verified:
+            if received is not None:
+                logging.warning("Chunk {} of {} from {} doesn't match its "
+                                "digest".format(preamble.chunk,
+                                                preamble.filename,
+                                                self._addr))
+            self._discard(preamble)
+            return
+
+        store.commit_chunk(preamble.filename, preamble.file_length,
+                           preamble.total_chunks, preamble.chunk,
+                           digest.digest, digest.strong,
+                           preamble.file_digest, partial=self._tag,
+                           offset=preamble.offset)
+        if store.has_all_chunks(preamble.filename, preamble.file_length,
+                                preamble.total_chunks):
+            self._receiver.assembler.submit(preamble.filename,
+                                            preamble.file_length,
+                                            preamble.total_chunks)
+
+    def _discard(self, preamble):
+        # Partial files are a connection's own, nothing else will pick up
+        # one it abandons
+        store = self._receiver.store
+        store.discard_chunk(
+            preamble.filename, preamble.file_length, preamble.total_chunks,
+            preamble.chunk, partial=self._tag, offset=preamble.offset)
+
+        # A copy sent again that failed may have been all that was holding
+        # up publishing the file
+        if store.has_all_chunks(preamble.filename, preamble.file_length,
+                                preamble.total_chunks):
+            self._receiver.assembler.submit(preamble.filename,
+                                            preamble.file_length,
+                                            preamble.total_chunks)
+
+    def _xmodem_recv(self, preamble, pending=b""):
+        # Runs on a transfer worker, everything touching the stream is
+        # handed back to the event loop. Anything the parser read past the
+        # start of the transfer is served first
+        loop = self._receiver.loop
+        pending = bytearray(pending)
+        codec = preamble.codec
+
+        def _getc(size, timeout=1):
+            read = bytes(pending[:size])
+            del pending[:size]
+
+            if len(read) < size:
+                future = asyncio.run_coroutine_threadsafe(
+                    asyncio.wait_for(
+                        self._reader.readexactly(size - len(read)),
+                        timeout),
+                    loop)
+                try:
+                    read += future.result()
+                except asyncio.TimeoutError:
+                    pending[:0] = read
+                    read = None
+                except asyncio.IncompleteReadError:
+                    # Nothing more is coming, so stop the transfer
+                    # rather than letting it retry against a closed
+                    # connection
+                    raise DataReceiverRuntimeError(
+                        "{} closed the connection during the "
+                        "transfer".format(self._addr))
+
+            logging.debug("READ {} DATA: {}".format(
+                size,
+                str(int.from_bytes(read,
+                                   sys.byteorder))
+                if read else "none"))
+            return read or None
+
+        def _putc(msg, timeout=1):
+            logging.debug("WRITE DATA: {}".format(msg))
+            loop.call_soon_threadsafe(self._send, bytes(msg))
+            return len(msg)
+
+        if self._caps & CAP_WINDOW:
+            xfer = SlidingWindow(_getc, _putc)
+        else:
+            xfer = xmodem.XMODEM(_getc, _putc)
+        store = self._receiver.store
+        with store.open_chunk(preamble.filename, preamble.file_length,
+                              preamble.total_chunks, preamble.chunk,
+                              preamble.offset, preamble.length,
+                              partial=self._tag,
+                              whole=preamble.file_digest) as fh:
+            digest = DigestWriter(fh, preamble.length)
+            out = DecompressingWriter(digest, codec) if codec else digest
+            received = xfer.recv(out)
+
+            if received is not None and codec:
+                try:
+                    received = out.finish()
+                except CompressionException as e:
+                    logging.warning("Chunk {} of {}: {}".format(
+                        preamble.chunk, preamble.filename, e))
+                    received = None
+            return received, digest
+
 
 class DataReceiverConfigurationError(Exception):
     pass
@@ -245,11 +400,15 @@ if __name__ == '__main__':
     logging.info("PyRMDataReceiver")
 
     a = argparse.ArgumentParser()
+    a.add_argument("-c", "--max-transfers", help="Number of transfers that can run at once", default=32, type=int)
+    a.add_argument("-t", "--timeout", help="Seconds before an idle connection is closed", default=120, type=int)
     a.add_argument("port", help="TCP port to listen on", type=int)
     a.add_argument("directory", help="Output directory")
     args = a.parse_args()
 
-    dm = DataReceiver(args.port, args.directory)
+    dm = DataReceiver(args.port, args.directory,
+                      max_transfers=args.max_transfers,
+                      timeout=args.timeout)
 
     dm.thread.join()
     logging.info("Stopped listening for data...")
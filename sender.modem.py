@@ -1,202 +1,872 @@
 import argparse
-import binascii
+import compression
+import contextlib
+import functools
 import logging
+import multiprocessing.connection
 import os
-import re
 import serial
 import stat
-import struct
 import sys
 import time as tm
 import xmodem
 
+from capture import CaptureConnection, WireCapture
+from compression import CODEC_NONE, CODEC_ZSTD, CODECS, CompressingReader
+from collections import deque, namedtuple
 from datetime import datetime
+from journal import Journal
+from link import LinkController
+from modem import Modem, ModemException
+from monitor import SignalMonitor
+from spool import Spool
+from protocol import CAP_1K, CAP_COMPRESS, CAP_DIGEST, CAP_FEC, CAP_INLINE, \
+    CAP_PIPELINE, CAP_WINDOW, CAP_ZSTD, DIGEST_SIZE, FILENAME, GOFORIT, \
+    INLINE_MAX, NAMERECV, NEGOTIATE, PREAMBLE_CODEC_MASK, \
+    PREAMBLE_CODEC_SHIFT, PREAMBLE_RESUME, RESUME_ENTRY, RESUME_HEADER, \
+    RESUME_TAIL, STARTXFER, \
+    VERDICT, VERDICT_CRC, VERDICT_FRAME, WAKE, WAKE_REPLY, ChunkDigest, \
+    ProtocolException, file_digest, pack_pipelined, pack_preamble, \
+    unpack_resume, unpack_verdict
+from window import MAX_GROUP, SlidingWindow
 
+adaptive = True
+baudrate = 9600
+call_budget = 0
+capabilities = 0
+chunk_retries = 3
+chunk_size = 32768
+compress = "auto"
 connection = None
+controller = None
+debug = False
+driver = None
+fec_group = 16
+fec_loss = 0.0
+file_chunk_sizes = {}
+inline_size = 512
+journal = None
 lineend = "\r"
+max_redials = 3
+min_signal = 3
 modem = True
+monitor = None
+negotiate = True
+negotiate_timeout = 10
+negotiated = False
 ping = False
-re_modem_resp = re.compile(b"""(OK
-              |ERROR
-              |BUSY
-              |NO\ DIALTONE
-              |NO\ CARRIER
-              |RING
-              |NO\ ANSWER
-              |READY
-              |GOFORIT
-              |NAMERECV
-              |CONNECT(?:\s+\d+)?)
-              [\r\n]*$""", re.X)
-re_signal = re.compile(r'^\+CSQ:(\d)', re.MULTILINE)
-
-FILENAME = 0x1c
-GOFORIT = 0x1d
-STARTXFER = 0x1e
-NAMERECV = 0x1f
-
-
-def _signal_check(min_signal=3):
-    # Check we have a good enough signal to work with (>3)
-    signal_test = _send_receive_messages("AT+CSQ?", command=True)
-    if signal_test == "":
-        raise Exception(
-            "No response received for signal quality check")
-    signal_level = re_signal.search(signal_test)
+resume = True
+signal_interval = 60
+spool_interval = 30
+wake_interval = 5
+wake_retries = 24
 
-    if signal_level:
-        try:
-            signal_level = int(signal_level.group(1))
-            logging.debug("Got signal level {}".format(signal_level))
-        except ValueError:
-            raise Exception(
-                "Could not interpret signal from response: {}".format(
-                    signal_test))
-    else:
-        raise Exception(
-            "Could not interpret signal from response: {}".format(signal_test))
+requested_caps = CAP_1K | CAP_WINDOW | CAP_COMPRESS | CAP_PIPELINE | \
+    CAP_INLINE | CAP_DIGEST | CAP_FEC | \
+    (CAP_ZSTD if CODEC_ZSTD in compression.available() else 0)
 
-    if type(signal_level) == int and signal_level >= min_signal:
-        return True
-    return False
+# Chunks must hold whole XMODEM blocks so that only the final chunk of a
+# file is padded, which the receiver trims against the file length
+CHUNK_ALIGN = 1024
 
+# A chunk to send over whichever modem gets to it first
+Stripe = namedtuple("Stripe", ["filename", "chunk", "total_chunks", "offset",
+                               "length", "codec", "digest", "strong",
+                               "whole", "data"])
 
-def _start_data_call():
-    if args.modem:
-        _send_receive_messages("AT", command=True)
-        _send_receive_messages("ATE0\n", command=True)
-        _send_receive_messages("AT+SBDC", command=True)
 
-        while not _signal_check():
-            tm.sleep(3)
+class ChunkReader(object):
+    """
+    File-like view over one chunk of a file, read in place from the source
+    so splitting doesn't need temporary copies
+    """
 
-        response = _send_receive_messages("ATDT00881600005478", command=True)
-        if not response.splitlines()[-1].startswith("CONNECT "):
-            raise Exception(
-                "Error opening call: {}".format(response))
+    def __init__(self, fileno, offset, length):
+        self._fileno = fileno
+        self._pos = offset
+        self._end = offset + length
+
+    def read(self, size=-1):
+        remaining = self._end - self._pos
+        if size < 0 or size > remaining:
+            size = remaining
+        if size <= 0:
+            return b""
+
+        data = os.pread(self._fileno, size, self._pos)
+        self._pos += len(data)
+        return data
+
+
+def _chunk_digests(fileno, chunks, block_size=65536):
+    """
+    Digests of every chunk in a single pass over the file, which serve the
+    preambles, the resume comparison and the journal alike
+    """
+    digests = []
+    for (offset, length) in chunks:
+        reader = ChunkReader(fileno, offset, length)
+        digest = ChunkDigest(length)
+        block = reader.read(block_size)
+        while block:
+            digest.update(block)
+            block = reader.read(block_size)
+        digests.append(digest)
+    return digests
+
+
+def _chunk_ranges(file_length, size):
+    if size <= 0 or file_length <= size:
+        return [(0, file_length)]
+    return [(offset, min(size, file_length - offset))
+            for offset in range(0, file_length, size)]
+
+
+def _start_data_call():
+    if modem:
+        driver.command("AT")
+        driver.command("ATE0")
+        driver.command("AT+SBDC")
+
+        # Check we have a good enough signal to work with
+        level = driver.wait_for_signal(min_signal)
+        if controller is not None:
+            controller.signal(level)
+        if monitor is not None:
+            monitor.record(level)
+        driver.dial("00881600005478")
     return True
 
 
-# TODO: Too much sleeping, use state based logic
 def _end_data_call():
-    global connection
+    if modem:
+        driver.hangup()
+
+
+def _drop_data_call():
+    # After a failure the call may already be gone, in which case there's
+    # nothing to escape from and we just need the modem listening again
+    if modem:
+        try:
+            driver.hangup()
+        except ModemException as e:
+            logging.warning("Could not hang up cleanly, assuming the call "
+                            "has dropped: {}".format(e))
+            driver.reset()
+
+
+def _process_files(files, on_sent=None):
+    """
+    Sends the files over as few calls as possible: dial once, send the
+    queue back to back, and hang up when it's empty or the call budget is
+    spent. A failed file redials and carries on, the resume query means
+    only its missing chunks go again. Returns the files not sent
+    """
+    queue = deque(files)
+    in_call = False
+    call_started = None
+    redials = 0
+
+    while queue:
+        filename = queue[0]
+
+        if in_call and call_budget and \
+                tm.monotonic() - call_started > call_budget:
+            logging.warning("Call budget of {} seconds spent with {} files "
+                            "left".format(call_budget, len(queue)))
+            break
+
+        logging.info("Processing {}".format(filename))
+        try:
+            # A dial that fails counts against the redials like a call
+            # that drops
+            if not in_call:
+                _start_data_call()
+                in_call = True
+                call_started = tm.monotonic()
+
+            _process_file_message(filename)
+        except Exception as e:
+            if redials >= max_redials:
+                _drop_data_call()
+                raise
+
+            if controller is not None:
+                controller.dropped()
+            redials += 1
+            logging.warning("Sending {} failed, redialling ({} of {}): "
+                            "{}".format(filename, redials, max_redials, e))
+            _drop_data_call()
+            in_call = False
+            continue
+
+        redials = 0
+        queue.popleft()
+        file_chunk_sizes.pop(filename, None)
+        if callable(on_sent):
+            on_sent(filename)
+
+    if in_call:
+        _end_data_call()
+    return list(queue)
+
+
+def _process_spool(outbox, process=_process_files):
+    """
+    Runs as a daemon over an outbox, sending whatever is most urgent each
+    time files are waiting and leaving the rest for the next call
+    """
+    global journal, monitor
+
+    spool = Spool(outbox)
+    if journal is None:
+        journal = Journal(os.path.join(outbox, ".journal.db"))
+    logging.info("Watching {}, {} files waiting".format(outbox, len(spool)))
+
+    # Between calls the signal is sampled, so the next call waits for one
+    # good enough to carry what's queued
+    if modem and driver is not None and signal_interval:
+        monitor = SignalMonitor(driver, signal_interval)
+        monitor.start()
+
+    while True:
+        # Only plan as much as the call budget can carry at the line rate
+        budget = call_budget * baudrate / 10 \
+            if call_budget else None
+        batch = spool.schedule(budget)
+
+        if not batch:
+            spool.wait(spool_interval)
+            continue
+
+        seconds = spool.size(batch) / (baudrate / 10.0)
+        if monitor is not None and not monitor.ready(seconds, min_signal):
+            logging.info("Signal too poor for {} files, waiting".format(
+                len(batch)))
+            spool.wait(spool_interval)
+            continue
+
+        logging.info("Sending {} of {} waiting files".format(
+            len(batch), len(spool)))
+        try:
+            with monitor.busy() if monitor is not None \
+                    else contextlib.nullcontext():
+                process(batch, on_sent=spool.mark_sent)
+        except Exception:
+            logging.exception("Sending from {} failed, trying again in {} "
+                              "seconds".format(outbox, spool_interval))
+            tm.sleep(spool_interval)
+        spool.scan()
+
+
+def _callback(total_packets, success_count, error_count):
+    logging.debug("{} packets, {} success, {} errors".format(total_packets,
+                                                             success_count,
+                                                             error_count))
 
-    if args.modem:
-        logging.debug("Two second sleep")
-        tm.sleep(2)
-        logging.debug("Two second sleep complete")
-        response = _send_receive_messages("+++".encode(), raw=True, command=True)
-        logging.debug("One second sleep")
-        tm.sleep(1)
-        logging.debug("One second sleep complete")
 
-        if response.splitlines()[-1] != "OK":
+def _getc(size, timeout=1):
+    default_timeout = connection.timeout
+    connection.timeout = timeout
+    try:
+        read = connection.read(size=size) or None
+    finally:
+        connection.timeout = default_timeout
+    logging.debug("_getc read {} bytes from data line".format(
+        len(read) if read else "no"
+    ))
+    return read
+
+
+def _putc(data, timeout=1):
+    logging.debug("_putc wrote {} bytes to data line".format(
+        len(data) if data else "no"
+    ))
+    size = driver.write(data)
+    return size
+
+
+def _read_digests(fh, chunks, file_length):
+    """
+    The digests of the chunks and of the whole file, and the data itself
+    if the file is small enough to go inline in its preamble
+    """
+    data = None
+    if len(chunks) == 1 and file_length <= inline_size:
+        data = fh.read(file_length)
+        digests = [ChunkDigest(file_length)]
+        digests[0].update(data)
+    else:
+        digests = _chunk_digests(fh.fileno(), chunks)
+    whole = file_digest([digest.strong for digest in digests])
+    return (data, digests, whole)
+
+
+def _send_file_chunk(fh, filename, chunk, total_chunks, offset, length,
+                     codec, strong, whole, data=None):
+    # Only this chunk goes again if the receiver finds it doesn't match
+    # its digest
+    for attempt in range(chunk_retries + 1):
+        used = _send_filename(filename, chunk, total_chunks, codec=codec,
+                              data=data, digests=(strong, whole),
+                              chunk_range=(offset, length))
+        if used is None:
+            logging.info("Receiver took {} inline".format(filename))
+            return
+
+        if not _send_chunk(ChunkReader(fh.fileno(), offset, length),
+                           length, used, _getc, _putc, _callback):
             raise Exception(
-                "Did not switch to command mode to end call")
+                "Transfer of chunk {} of {} failed".format(chunk, filename))
+        logging.debug("Finished transfer of chunk {}".format(chunk))
 
-        response = _send_receive_messages("ATH0")
+        if not capabilities & CAP_DIGEST or _read_verdict(chunk):
+            return
+        logging.warning("Receiver found chunk {} of {} corrupt, sending it "
+                        "again".format(chunk, total_chunks))
 
-        if response.splitlines()[-1] != "OK":
-            raise Exception("Did not hang up the call")
-        else:
-            logging.debug("Sleeping another second to wait for the line")
-            tm.sleep(1)
+    raise Exception("Chunk {} of {} was corrupt {} times, giving up".format(
+        chunk, filename, chunk_retries + 1))
 
 
 def _process_file_message(filename):
-    global connection
+    st = os.stat(filename)
+    file_length = st[stat.ST_SIZE]
+
+    # A file keeps the chunk size it started with, or after a redial the
+    # receiver wouldn't recognise the chunks it holds
+    size = chunk_size
+    if controller is not None:
+        size = file_chunk_sizes.setdefault(filename, controller.chunk_size)
+    chunks = _chunk_ranges(file_length, size)
+
+    # The journal knows a file by its path and modification time, so a
+    # changed file is sent again
+    name = os.path.abspath(filename)
+    mtime = st.st_mtime_ns
+    if journal is not None and \
+            journal.is_complete(name, file_length, len(chunks), mtime):
+        logging.info("{} has already been sent, skipping".format(filename))
+        return True
+
+    codec = _choose_codec(filename)
+
+    with open(filename, 'rb') as fh:
+        (data, digests, whole) = _read_digests(fh, chunks, file_length)
+
+        # Receivers from before negotiation drop the call on a resume
+        # query, so it's only sent to one that has answered a negotiation
+        held = None
+        if resume and negotiate and len(chunks) > 1:
+            held = _send_filename(filename, 0, len(chunks), resume=True,
+                                  digests=(bytes(DIGEST_SIZE), whole))
+        if held is None and journal is not None:
+            # Without asking the receiver, what it acknowledged before is
+            # the best we have
+            held = journal.chunks(name, file_length, len(chunks), mtime)
+        held = held or {}
+
+        for chunk, (offset, length) in enumerate(chunks, start=1):
+            digest = digests[chunk - 1]
+            if chunk in held and held[chunk] == digest.digest:
+                logging.info("Receiver already holds chunk {} of {}, "
+                             "skipping".format(chunk, len(chunks)))
+                continue
+
+            logging.info("Sending chunk {} of {}: {} bytes at {}".format(
+                chunk, len(chunks), length, offset))
+            _send_file_chunk(fh, filename, chunk, len(chunks), offset,
+                             length, codec, digest.strong, whole, data)
+
+            if journal is not None:
+                journal.commit_chunk(name, file_length, len(chunks), chunk,
+                                     *digest.digest, offset=offset,
+                                     mtime=mtime, digest=digest.strong,
+                                     file_digest=whole)
+
+    if journal is not None:
+        journal.complete(name, file_length, len(chunks), mtime)
+    return True
+
+
+def _choose_codec(filename):
+    allowed = list(CODECS.values()) if compress == "auto" \
+        else [CODECS[compress]]
+    return compression.choose_codec(filename, allowed)
+
+
+def _plan_stripes(filename):
+    """
+    The chunks of a file that still need sending, as stripes for the
+    modems to share, and what the journal needs to know the file by
+    """
+    st = os.stat(filename)
+    file_length = st[stat.ST_SIZE]
+
+    # Every modem has to cut the file the same way, so the chunk size is
+    # the fixed one rather than any one link's
+    chunks = _chunk_ranges(file_length, chunk_size)
+    entry = (os.path.abspath(filename), file_length, len(chunks),
+             st.st_mtime_ns)
+    if journal is not None and journal.is_complete(*entry):
+        logging.info("{} has already been sent, skipping".format(filename))
+        return (entry, [])
+
+    codec = _choose_codec(filename)
+    with open(filename, 'rb') as fh:
+        (data, digests, whole) = _read_digests(fh, chunks, file_length)
+    held = journal.chunks(*entry) if journal is not None else {}
+
+    stripes = []
+    for chunk, (offset, length) in enumerate(chunks, start=1):
+        digest = digests[chunk - 1]
+        if held.get(chunk) == digest.digest:
+            continue
+        stripes.append(Stripe(filename, chunk, len(chunks), offset, length,
+                              codec, digest.digest, digest.strong, whole,
+                              data))
+    return (entry, stripes)
+
+
+def _next_stripe(queues, index):
+    """
+    The next stripe for a modem: the front of its own queue, or once
+    that's empty the back of the longest, furthest from where its owner
+    is working
+    """
+    if queues[index]:
+        return queues[index].popleft()
+    victim = max(queues, key=len)
+    return victim.pop() if victim else None
+
+
+def _process_striped(ports, files, virtual=False, on_sent=None):
+    """
+    Sends the files over several modems at once, each on a call of its
+    own. Their chunks are dealt out in runs, a queue per modem, and a
+    modem that runs dry takes from the others, so a slow link ends up
+    carrying less. A link that fails hands its chunk back and redials
+    while the rest carry on. Returns the files not sent
+    """
+    context = multiprocessing.get_context("fork")
+    entries = {}
+    pending = {}
+    stripes = []
+    for filename in files:
+        (entries[filename], planned) = _plan_stripes(filename)
+        pending[filename] = set(stripe.chunk for stripe in planned)
+        stripes.extend(planned)
+
+    def _sent(filename):
+        if journal is not None:
+            journal.complete(*entries[filename])
+        if callable(on_sent):
+            on_sent(filename)
+
+    for filename in files:
+        if not pending[filename]:
+            _sent(filename)
+    if not stripes:
+        return []
+
+    count = len(ports)
+    queues = [deque(stripes[i * len(stripes) // count:
+                            (i + 1) * len(stripes) // count])
+              for i in range(count)]
+
+    workers = {}
+    for (index, port) in enumerate(ports):
+        (ours, theirs) = context.Pipe()
+        process = context.Process(target=_stripe_worker,
+                                  args=(port, theirs, virtual),
+                                  name="stripe-{}".format(port))
+        process.start()
+        theirs.close()
+        workers[ours] = (index, process)
+    busy = {}
+    idle = {}
+
+    def _dispatch():
+        # Modems with nothing to do wait for chunks handed back by the
+        # others, until none are in flight and so none can be
+        for index in list(idle):
+            stripe = _next_stripe(queues, index)
+            if stripe is not None:
+                busy[index] = stripe
+                idle.pop(index).send(stripe)
+            elif not busy:
+                idle.pop(index).send(None)
+
+    while workers:
+        for pipe in multiprocessing.connection.wait(list(workers)):
+            (index, process) = workers[pipe]
+            try:
+                (status, stripe) = pipe.recv()
+            except EOFError:
+                # The modem has gone, any chunk it had goes back for one
+                # of the others
+                stripe = busy.pop(index, None)
+                if stripe is not None:
+                    queues[index].appendleft(stripe)
+                idle.pop(index, None)
+                process.join()
+                del workers[pipe]
+                _dispatch()
+                continue
+
+            busy.pop(index, None)
+            if status == "sent":
+                if journal is not None:
+                    (name, file_length, total_chunks, mtime) = \
+                        entries[stripe.filename]
+                    journal.commit_chunk(name, file_length, total_chunks,
+                                         stripe.chunk, *stripe.digest,
+                                         offset=stripe.offset, mtime=mtime,
+                                         digest=stripe.strong,
+                                         file_digest=stripe.whole)
+                pending[stripe.filename].discard(stripe.chunk)
+                if not pending[stripe.filename]:
+                    _sent(stripe.filename)
+            elif status in ("failed", "retired"):
+                queues[index].appendleft(stripe)
+            if status != "retired":
+                idle[index] = pipe
+            _dispatch()
+
+    return [filename for filename in files if pending[filename]]
+
+
+def _stripe_worker(port, pipe, virtual=False):
+    """
+    One modem of a striped send, in a process of its own so the
+    connection, driver and capabilities it negotiates are its own. Asks
+    for stripes until there are none left
+    """
+    global connection, controller, driver
+    connection = _open_port(port, virtual)
+    driver = Modem(connection, lineend=lineend)
+    if adaptive:
+        controller = LinkController(connection.baudrate / 10)
+
+    in_call = False
+    call_started = None
+    redials = 0
+    pipe.send(("ready", None))
+
+    try:
+        stripe = pipe.recv()
+        while stripe is not None:
+            if in_call and call_budget and \
+                    tm.monotonic() - call_started > call_budget:
+                logging.warning("Call budget of {} seconds spent on "
+                                "{}".format(call_budget, port))
+                pipe.send(("retired", stripe))
+                break
+
+            try:
+                if not in_call:
+                    _start_data_call()
+                    in_call = True
+                    call_started = tm.monotonic()
+
+                logging.info("Sending chunk {} of {} of {} on {}".format(
+                    stripe.chunk, stripe.total_chunks, stripe.filename,
+                    port))
+                with open(stripe.filename, 'rb') as fh:
+                    _send_file_chunk(fh, stripe.filename, stripe.chunk,
+                                     stripe.total_chunks, stripe.offset,
+                                     stripe.length, stripe.codec,
+                                     stripe.strong, stripe.whole,
+                                     stripe.data)
+            except Exception as e:
+                _drop_data_call()
+                in_call = False
+                if controller is not None:
+                    controller.dropped()
+
+                redials += 1
+                if redials > max_redials:
+                    pipe.send(("retired", stripe))
+                    logging.error("Giving up on {} after {} redials: "
+                                  "{}".format(port, max_redials, e))
+                    break
+                logging.warning("Sending on {} failed, redialling ({} of "
+                                "{}): {}".format(port, redials, max_redials,
+                                                 e))
+                pipe.send(("failed", stripe))
+            else:
+                redials = 0
+                pipe.send(("sent", stripe))
+            stripe = pipe.recv()
+    finally:
+        if in_call:
+            _end_data_call()
+        connection.close()
+
+
+def _send_chunk(stream, length, codec, getc, putc, callback):
+    global fec_loss
+
+    windowed = bool(capabilities & CAP_WINDOW)
+    block_size = 128
+    min_parity = 1
+    if capabilities & CAP_1K:
+        block_size = 1024
+    if controller is not None:
+        if capabilities & CAP_1K:
+            block_size = controller.block_size(windowed)
+        min_parity = controller.min_parity
+
+    if windowed:
+        logging.debug("Using sliding window mode with {} byte blocks".format(
+            block_size))
+        # The loss seen so far sets the parity for the next transfer
+        xfer = SlidingWindow(
+            getc, putc,
+            block_size=block_size,
+            rate=connection.baudrate / 10,
+            fec_group=fec_group if capabilities & CAP_FEC else 0,
+            min_parity=min_parity,
+            loss=fec_loss)
+    else:
+        mode = "xmodem1k" if block_size == 1024 else "xmodem"
+        logging.debug("Using {} mode".format(mode))
+        xfer = xmodem.XMODEM(getc, putc, mode=mode)
+
+    if codec != CODEC_NONE:
+        logging.debug("Compressing with codec {}".format(codec))
+        stream = CompressingReader(stream, codec)
+
+    stats = []
 
     def _callback(total_packets, success_count, error_count):
-        logging.debug("{} packets, {} success, {} errors".format(total_packets,
-                                                                 success_count,
-                                                                 error_count))
+        stats[:] = [success_count, error_count]
+        callback(total_packets, success_count, error_count)
 
-    def _getc(size, timeout=1):
-        read = connection.read(size=size) or None
-        logging.debug("_getc read {} bytes from data line".format(
-            len(read) if read else "no"
-        ))
-        return read
-
-    def _putc(data, timeout=1):
-        logging.debug("_putc wrote {} bytes to data line".format(
-            len(data) if data else "no"
-        ))
-        size = connection.write(data=data)
-        return size
-
-    if _start_data_call():
-        _send_filename(filename)
-
-        xfer = xmodem.XMODEM(_getc, _putc)
-
-        stream = open(filename, 'rb')
-        xfer.send(stream, callback=_callback)
-        logging.debug("Finished transfer")
-        _end_data_call()
+    try:
+        return xfer.send(stream, callback=_callback)
+    finally:
+        if windowed:
+            fec_loss = xfer.loss
+        if controller is not None and stats:
+            controller.transferred(length, block_size, *stats,
+                                   windowed=windowed,
+                                   rtt=xfer.rtt if windowed else None)
 
-        return True
-    return False
+
+def _read_verdict(chunk):
+    """
+    Whether the receiver found the chunk matched its digest. Late
+    acknowledgements from the transfer can arrive first, so we look for
+    the first thing that checks out as the verdict on this chunk
+    """
+    global connection
+
+    size = VERDICT_FRAME.size + VERDICT_CRC.size
+    buffer = bytearray()
+
+    while True:
+        start = buffer.find(VERDICT)
+        if start < 0:
+            del buffer[:]
+        else:
+            del buffer[:start]
+            if len(buffer) >= size:
+                verdict = unpack_verdict(bytes(buffer[:size]))
+                if verdict is not None and verdict[0] == chunk:
+                    return verdict[1]
+                del buffer[:1]
+                continue
+
+        read = connection.read(connection.in_waiting or 1)
+        if not read:
+            raise Exception(
+                "No verdict on chunk {} from the receiver".format(chunk))
+        buffer += read
 
 
 def _send_receive_messages(message, raw=False, command=False,
                            no_response=False):
-    global connection, lineend, re_modem_resp
+    global connection
 
     if not connection.isOpen():
         raise Exception(
             'Cannot send message; data port is not open')
 
     if not raw:
-        sendstr = "{}{}".format(message.strip(), lineend).encode("latin-1") \
-            if command else None
-        connection.write(sendstr)
-        logging.info('Message sent: "{}"'.format(message.strip()))
+        return "\n".join(driver.command(message))
     else:
         # FIXME: Assuming int messages are single length
         sendstr = message \
                   if type(message) != int \
                   else message.to_bytes(1, sys.byteorder)
-        connection.write(sendstr)
+        driver.write(sendstr)
         logging.debug(
             "Binary message of length {} bytes sent".format(len(sendstr)))
 
     if no_response:
         return
 
+    # Blocks until something arrives or the port times out
     reply = bytearray()
-    modem_response = False
-
-    while not modem_response:
-        logging.debug("Waiting {}".format(connection.in_waiting))
+    while not len(reply):
         reply += connection.read(connection.in_waiting or 1)
-
         if not len(reply):
             logging.debug("Waiting for response...")
-            tm.sleep(1)
-            continue
+
+    logging.info("Response of {} bytes received".format(len(reply)))
+    return reply
+
+
+def _read_resume():
+    global connection
+
+    res = connection.read(1)
+    if res != NAMERECV.to_bytes(1, sys.byteorder):
+        raise Exception(
+            "Could not query chunks held for resume: {}".format(res))
+
+    data = connection.read(RESUME_HEADER.size)
+    if len(data) == RESUME_HEADER.size:
+        data += connection.read(RESUME_HEADER.unpack(data)[1] *
+                                RESUME_ENTRY.size + RESUME_TAIL.size)
+
+    try:
+        held = unpack_resume(data)
+    except ProtocolException as e:
+        raise Exception("Could not query chunks held for resume: {}".format(e))
+    logging.info("Receiver holds {} chunks".format(len(held)))
+    return held
+
+
+def _wake():
+    # Anything still buffered is left over from the last transfer, such as
+    # late acknowledgements, and would be taken for the replies below
+    connection.reset_input_buffer()
+
+    # The first can be lost while the receiver is still picking up the
+    # call, so keep sending until one is answered
+    timeout = connection.timeout
+    connection.timeout = wake_interval
+    try:
+        for attempt in range(wake_retries):
+            # Assuming byte order remains the same between hosts
+            logging.info("Sending {} init byte".format(
+                "another" if attempt else "the"))
+            _send_receive_messages(WAKE, raw=True, no_response=True)
+
+            res = connection.read_until(WAKE_REPLY.to_bytes(1, sys.byteorder))
+            if res.endswith(WAKE_REPLY.to_bytes(1, sys.byteorder)):
+                logging.info("Received init byte response")
+                return
+    finally:
+        connection.timeout = timeout
+
+    raise Exception("No response to {} init bytes".format(wake_retries))
+
+
+def _negotiate(caps):
+    global connection, negotiate
+
+    # Receivers that predate negotiation ignore the request, so only wait
+    # a short while before going back to the legacy FILENAME command
+    timeout = connection.timeout
+    connection.timeout = negotiate_timeout
+    try:
+        _send_receive_messages(NEGOTIATE.to_bytes(1, sys.byteorder) +
+                               caps.to_bytes(1, sys.byteorder),
+                               raw=True, no_response=True)
+        res = connection.read_until(GOFORIT.to_bytes(1, sys.byteorder))
+        if res.endswith(GOFORIT.to_bytes(1, sys.byteorder)):
+            res = connection.read(1)
         else:
-            if command:
-                cmd_match = re_modem_resp.search(reply.strip())
-                if cmd_match:
-                    tm.sleep(0.1)
-                    if not connection.in_waiting:
-                        modem_response = True
-            else:
-                # TODO: NO CARRIER DETECT
-                modem_response = True
+            res = b""
+    finally:
+        connection.timeout = timeout
 
-    if raw:
-        logging.info("Response of {} bytes received".format(len(reply)))
-    else:
-        reply = reply.decode().strip()
-        logging.info('Response received: "{}"'.format(reply))
+    if len(res) == 1:
+        logging.info("Receiver accepted capabilities {:#04x}".format(res[0]))
+        return res[0]
+
+    logging.warning("No response to capability negotiation, using the "
+                    "legacy handshake from now on")
+    negotiate = False
+    return None
+
+
+def _pipeline(preamble):
+    """
+    The whole handshake in one message, for a receiver that has accepted
+    CAP_PIPELINE before. Returns the capabilities it accepts, or None if
+    it doesn't answer and we need the full handshake
+    """
+    global connection
+
+    connection.reset_input_buffer()
+    timeout = connection.timeout
+    connection.timeout = negotiate_timeout
+    try:
+        _send_receive_messages(pack_pipelined(requested_caps, preamble),
+                               raw=True, no_response=True)
+        res = connection.read_until(GOFORIT.to_bytes(1, sys.byteorder))
+        if res.endswith(GOFORIT.to_bytes(1, sys.byteorder)):
+            res = connection.read(1)
+        else:
+            res = b""
+    finally:
+        connection.timeout = timeout
+
+    if len(res) == 1:
+        logging.debug("Pipelined handshake accepted with capabilities "
+                      "{:#04x}".format(res[0]))
+        return res[0]
+
+    logging.warning("No response to the pipelined handshake, going back to "
+                    "the full handshake")
+    return None
 
-    return reply
 
+def _preamble(filename, chunk, total_chunks, resume, codec, data=None,
+              digests=None, chunk_range=None):
+    # Small files go in the preamble to receivers that take them, which is
+    # signalled by a codec of None as there's no transfer to follow
+    if data is not None and capabilities & CAP_INLINE:
+        return pack_preamble(os.path.basename(filename).encode("latin-1"),
+                             len(data), chunk, total_chunks,
+                             data=data), None
 
-def _send_filename(filename):
-    global ping
+    # Only compress for receivers that said they can decompress
+    if not capabilities & CAP_COMPRESS or \
+            (codec == CODEC_ZSTD and not capabilities & CAP_ZSTD):
+        codec = CODEC_NONE
+
+    # A resume query is sent as chunk 0, the receiver replies with the
+    # chunks it already holds and doesn't expect a transfer
+    flags = PREAMBLE_RESUME if resume else 0
+    flags |= codec << PREAMBLE_CODEC_SHIFT & PREAMBLE_CODEC_MASK
+    if not capabilities & CAP_DIGEST:
+        digests = None
+        chunk_range = None
+    elif resume:
+        # A resume query has no chunk, only the digest of the whole file,
+        # so a receiver that has published it can tell it's the same one
+        chunk_range = None
+    return pack_preamble(os.path.basename(filename).encode("latin-1"),
+                         os.stat(filename)[stat.ST_SIZE],
+                         chunk, total_chunks, flags,
+                         digests=digests, chunk_range=chunk_range), codec
+
+
+def _send_filename(filename, chunk=1, total_chunks=1, resume=False,
+                   codec=CODEC_NONE, data=None, digests=None,
+                   chunk_range=None):
+    """
+    Handshake for a chunk, returning the codec to send it with, or None
+    if the receiver took data, the whole file, inline. A resume query
+    returns the chunks held instead, or None if the receiver didn't
+    negotiate and so can't be asked
+    """
+    global capabilities, negotiated, ping
 
     if ping:
         logging.warning("PING MODE: we'll only be sending single bytes")
@@ -207,84 +877,240 @@ def _send_filename(filename):
     else:
         logging.info("Standard processing")
 
-    # Assuming byte order remains the same between hosts
-    logging.info("Sending init byte")
-    res = _send_receive_messages(b"@", raw=True)
+    # Until a receiver has negotiated, a resume query waits for the full
+    # handshake to show it can take one
+    if negotiate and capabilities & CAP_PIPELINE and \
+            (negotiated or not resume):
+        (buffer, codec) = _preamble(filename, chunk, total_chunks, resume,
+                                    codec, data, digests, chunk_range)
+        accepted = _pipeline(buffer)
 
-    while res[-1] != int.from_bytes(b"A", sys.byteorder):
-        logging.info("Sending another init byte")
-        res = _send_receive_messages(b"@", raw=True)
+        if accepted is not None:
+            capabilities = accepted
+            negotiated = True
+            if resume:
+                return _read_resume()
 
-    logging.info("Received init byte response")
-    res = _send_receive_messages(FILENAME, raw=True)
+            res = connection.read(1)
+            if res != NAMERECV.to_bytes(1, sys.byteorder):
+                raise Exception(
+                    "Could not transfer filename first: {}".format(res))
+            return codec
+        capabilities = 0
 
-    if res != GOFORIT.to_bytes(1, sys.byteorder):
-        raise Exception(
-            "Required response for FILENAME command not received")
-
-    # We can only have two byte lengths, and we don't escape the two
-    # markers characters since we're using the length marker with
-    # otherwise fixed fields. We just use 0x1b as validation of the
-    # last byte of the message
-    bfile = os.path.basename(filename).encode("latin-1")[:255]
-    file_length = os.stat(filename)[stat.ST_SIZE]
-    length = len(bfile)
-    buffer = bytearray()
-    buffer += struct.pack("BB", 0x1a, length)
-    buffer += struct.pack("{}s".format(length), bfile)
-    buffer += struct.pack("q", file_length)
-    buffer += struct.pack("q", 1)
-    buffer += struct.pack("q", 1)
-    buffer += struct.pack("iB",
-                          binascii.crc32(bfile) & 0xffff,
-                          0x1b)
+    _wake()
+
+    accepted = None
+    if negotiate:
+        accepted = _negotiate(requested_caps)
+        if accepted is None:
+            _wake()
+
+    negotiated = accepted is not None
+    if accepted is None:
+        _send_receive_messages(FILENAME, raw=True, no_response=True)
+        # A wake up that was sent again can be answered late
+        res = connection.read_until(GOFORIT.to_bytes(1, sys.byteorder))
+
+        if res.lstrip(WAKE_REPLY.to_bytes(1, sys.byteorder)) != \
+                GOFORIT.to_bytes(1, sys.byteorder):
+            raise Exception(
+                "Required response for FILENAME command not received")
+        accepted = 0
+    capabilities = accepted
+
+    if resume and not negotiated:
+        return None
+
+    (buffer, codec) = _preamble(filename, chunk, total_chunks, resume, codec,
+                                data, digests, chunk_range)
+
+    if resume:
+        _send_receive_messages(buffer, raw=True, no_response=True)
+        return _read_resume()
 
     res = _send_receive_messages(buffer, raw=True)
     if res[0] != NAMERECV:
         raise Exception(
             "Could not transfer filename first: {}".format(res))
-    _send_receive_messages(STARTXFER, no_response=True, raw=True)
+    if codec is not None:
+        _send_receive_messages(STARTXFER, no_response=True, raw=True)
+    return codec
 
-
-def main(port, files, virtual=False):
-    global connection
+def _open_port(port, virtual=False):
     connection = serial.Serial(
         port=port,
         timeout=float(60),
         write_timeout=float(60),
-        baudrate=9600,
+        baudrate=baudrate,
         bytesize=serial.EIGHTBITS,
         parity=serial.PARITY_NONE,
         stopbits=serial.STOPBITS_ONE,
         rtscts=virtual,
         dsrdtr=virtual
     )
+    if debug:
+        connection = CaptureConnection(connection, WireCapture(
+            "debug.{}.{}.wcap".format(os.path.basename(port),
+                                      datetime.now().strftime(
+                                          "%d%m%Y-%H%M%S"))))
+    return connection
+
+
+def main(ports, files, virtual=False, outbox=None):
+    global connection, controller, driver
+
+    queue = []
+    for file in files:
+        if not os.path.isfile(file):
+            logging.warning("{} is not a regular file, skipping".
+                            format(file))
+        else:
+            queue.append(file)
+
+    # With several modems each gets its own connection, in its own process
+    if len(ports) > 1:
+        process = functools.partial(_process_striped, ports,
+                                    virtual=virtual)
+        unsent = process(queue)
+        if unsent:
+            logging.warning("Not sent: {}".format(", ".join(unsent)))
+
+        if outbox:
+            _process_spool(outbox, process)
+        if journal is not None:
+            journal.close()
+        return
+
+    connection = _open_port(ports[0], virtual)
+    driver = Modem(connection, lineend=lineend)
+    if adaptive:
+        controller = LinkController(connection.baudrate / 10,
+                                    chunking=bool(chunk_size),
+                                    chunk_align=CHUNK_ALIGN)
 
     try:
         if connection.is_open:
-            for file in files:
-                logging.info("Processing {}".format(file))
-
-                if not os.path.isfile(file):
-                    logging.warning("{} is not a regular file, skipping".
-                                    format(file))
-                else:
-                    _process_file_message(file)
+            unsent = _process_files(queue)
+            if unsent:
+                logging.warning("Not sent: {}".format(", ".join(unsent)))
+
+            if outbox:
+                _process_spool(outbox)
         else:
             raise RuntimeError("Port isn't open")
     finally:
         connection.close()
+        if journal is not None:
+            journal.close()
 
 
 if __name__ == "__main__":
     a = argparse.ArgumentParser()
-    a.add_argument("-p", "--port", default="ttyDUFF")
+    a.add_argument("-p", "--port", dest="ports", action="append",
+                   help="Serial port of the modem, given more than once to "
+                        "stripe chunks over several modems at once "
+                        "(default ttyDUFF)")
     a.add_argument("-t", "--test", default=False, action="store_true")
+    a.add_argument("-d", "--debug", default=False, action="store_true",
+                   help="Capture everything on the line to "
+                        "debug.<port>.<time>.wcap, which decompose reads")
     a.add_argument("-m", "--modem", dest="modem", action="store_false",
                    default=True)
-    a.add_argument("files", nargs="+")
+    a.add_argument("-b", "--budget", default=call_budget, type=int,
+                   help="Stop sending and hang up once a call has lasted "
+                        "this many seconds (0 for no limit)")
+    a.add_argument("-R", "--redials", default=max_redials, type=int,
+                   help="Redial this many times in a row when a file fails")
+    a.add_argument("-c", "--chunk-size", default=chunk_size, type=int,
+                   help="Split files into chunks of this many bytes, sent as "
+                        "separate transfers (multiple of {}, 0 to disable), "
+                        "adapted to the link unless --fixed".
+                   format(CHUNK_ALIGN))
+    a.add_argument("-z", "--compress", default=compress,
+                   choices=["auto"] + sorted(CODECS.keys()),
+                   help="Compression codec, auto picks one per file from a "
+                        "sample of its contents")
+    a.add_argument("-I", "--inline-size", default=inline_size, type=int,
+                   help="Send files up to this many bytes inside the "
+                        "preamble rather than as a transfer (0 to disable, "
+                        "at most {})".format(INLINE_MAX))
+    a.add_argument("-x", "--fixed", dest="adaptive", action="store_false",
+                   default=True,
+                   help="Keep the block size, parity and chunk size fixed "
+                        "rather than adapting them to the link")
+    a.add_argument("-k", "--no-1k", dest="large_blocks", action="store_false",
+                   default=True,
+                   help="Don't offer XMODEM-1K, always use 128 byte blocks")
+    a.add_argument("-W", "--no-window", dest="window", action="store_false",
+                   default=True,
+                   help="Don't offer the sliding window transport, always "
+                        "use XMODEM")
+    a.add_argument("-F", "--fec-group", default=fec_group, type=int,
+                   help="Follow every group of this many blocks with parity "
+                        "to repair losses in the sliding window transport "
+                        "(0 to disable, at most {})".format(MAX_GROUP))
+    a.add_argument("-P", "--no-pipeline", dest="pipeline",
+                   action="store_false", default=True,
+                   help="Always use the full handshake, one round trip per "
+                        "step")
+    a.add_argument("-l", "--legacy", dest="negotiate", action="store_false",
+                   default=True,
+                   help="Use the legacy FILENAME handshake without "
+                        "negotiating capabilities")
+    a.add_argument("-r", "--no-resume", dest="resume", action="store_false",
+                   default=True,
+                   help="Don't ask the receiver which chunks it already holds")
+    a.add_argument("-j", "--journal",
+                   help="Record what has been sent in this file, so a "
+                        "restart doesn't send it again (defaults to "
+                        ".journal.db in the outbox when spooling)")
+    a.add_argument("-s", "--spool", metavar="OUTBOX",
+                   help="Keep running and send files as they arrive in "
+                        "OUTBOX, numbered subdirectories setting priority")
+    a.add_argument("-i", "--interval", default=spool_interval, type=int,
+                   help="Seconds between checks of the outbox, and before "
+                        "retrying after a failed call")
+    a.add_argument("-S", "--signal-interval", default=signal_interval,
+                   type=int,
+                   help="Seconds between signal samples while spooling "
+                        "between calls, which hold calls back until the "
+                        "signal suits what's queued (0 to disable)")
+    a.add_argument("-q", "--min-signal", default=min_signal, type=int,
+                   choices=range(0, 6),
+                   help="Signal level needed before dialling")
+    a.add_argument("files", nargs="*")
     args = a.parse_args()
+    if not args.files and not args.spool:
+        a.error("give files to send or an outbox to watch")
+    if args.chunk_size % CHUNK_ALIGN:
+        a.error("chunk size must be a multiple of {}".format(CHUNK_ALIGN))
+    if not 0 <= args.fec_group <= MAX_GROUP:
+        a.error("FEC group must be between 0 and {}".format(MAX_GROUP))
+    if not 0 <= args.inline_size <= INLINE_MAX:
+        a.error("inline size must be between 0 and {}".format(INLINE_MAX))
     logging.basicConfig(level=logging.DEBUG)
+    adaptive = args.adaptive
+    call_budget = args.budget
+    chunk_size = args.chunk_size
+    compress = args.compress
+    debug = args.debug
+    fec_group = args.fec_group
+    inline_size = args.inline_size
+    negotiate = args.negotiate
+    requested_caps &= ~(0 if args.large_blocks else CAP_1K) & \
+        ~(0 if args.window else CAP_WINDOW) & \
+        ~(0 if args.pipeline else CAP_PIPELINE) & \
+        ~(0 if args.inline_size else CAP_INLINE) & \
+        ~(0 if args.fec_group else CAP_FEC) & \
+        ~(0 if args.compress != "none" else CAP_COMPRESS | CAP_ZSTD)
+    min_signal = args.min_signal
+    resume = args.resume
+    signal_interval = args.signal_interval
+    spool_interval = args.interval
+    if args.journal:
+        journal = Journal(args.journal)
+    max_redials = args.redials
     modem = args.modem
     ping = args.test
-    main(args.port, args.files, virtual=not args.modem)
+    main(args.ports or ["ttyDUFF"], args.files, virtual=not args.modem, outbox=args.spool)
@@ -0,0 +1,225 @@
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import select
+import struct
+import time
+
+# Files in the top of the outbox go at the default priority, files in a
+# numbered subdirectory at that priority, lower numbers first
+DEFAULT_PRIORITY = 5
+
+# Anything larger is bulk data and waits behind small files of the same
+# priority
+BULK_SIZE = 65536
+
+SENT_DIR = ".sent"
+STATE_FILE = ".spool.json"
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_ISDIR = 0x40000000
+
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class Inotify(object):
+    """Just enough of inotify, through libc, to hear about new files"""
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"),
+                                 use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._watches = {}
+
+    def add_watch(self, path, mask):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(),
+                          "inotify_add_watch failed for {}".format(path))
+        self._watches[wd] = path
+        return wd
+
+    def read(self, timeout):
+        """(directory, mask, name) for each event within timeout"""
+        (ready, _, _) = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return []
+
+        try:
+            data = os.read(self._fd, 65536)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            (wd, mask, cookie, length) = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if wd in self._watches:
+                events.append((self._watches[wd], mask, name))
+        return events
+
+    def close(self):
+        os.close(self._fd)
+
+
+class Spool(object):
+    """
+    Persistent queue of files waiting in an outbox directory. Sent files
+    are moved to .sent so a restart never sends them again, and when each
+    file was first seen is kept in .spool.json so its age survives too
+    """
+
+    def __init__(self, directory, settle=2, aging=3600):
+        self._dir = directory
+        self._sent = os.path.join(self._dir, SENT_DIR)
+        self._state_path = os.path.join(self._dir, STATE_FILE)
+        self._settle = settle
+        self._aging = aging
+        self._closed = set()
+
+        if not os.path.isdir(self._dir):
+            raise SpoolException("{} doesn't exist".format(self._dir))
+        os.makedirs(self._sent, exist_ok=True)
+
+        self._queue = self._load()
+
+        try:
+            self._inotify = Inotify()
+            for (directory, priority) in self._directories():
+                self._watch(directory)
+        except (AttributeError, OSError) as e:
+            logging.warning("Can't watch {}, polling it instead: {}".format(
+                self._dir, e))
+            self._inotify = None
+
+        self.scan()
+
+    def _load(self):
+        try:
+            with open(self._state_path) as fh:
+                return json.load(fh)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            logging.warning("Ignoring unreadable spool state {}".format(
+                self._state_path))
+            return {}
+
+    def _save(self):
+        partial = "{}.part".format(self._state_path)
+        with open(partial, "w") as fh:
+            json.dump(self._queue, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(partial, self._state_path)
+
+    def _watch(self, directory):
+        self._inotify.add_watch(directory,
+                                IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+
+    def _directories(self):
+        yield self._dir, DEFAULT_PRIORITY
+        for name in sorted(os.listdir(self._dir)):
+            path = os.path.join(self._dir, name)
+            if name.isdigit() and os.path.isdir(path):
+                yield path, int(name)
+
+    def scan(self):
+        """Brings the queue up to date with what's in the outbox"""
+        now = time.time()
+        queue = {}
+
+        for (directory, priority) in self._directories():
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                if name.startswith(".") or not os.path.isfile(path):
+                    continue
+
+                # Without a close or rename to go on, a file that changed
+                # recently might still be being written
+                st = os.stat(path)
+                if path not in self._closed and path not in self._queue \
+                        and now - st.st_mtime < self._settle:
+                    continue
+
+                entry = self._queue.get(path, {"first_seen": now})
+                entry.update(priority=priority, size=st.st_size)
+                queue[path] = entry
+
+        self._closed &= set(queue)
+        if queue != self._queue:
+            self._queue = queue
+            self._save()
+
+    def wait(self, timeout):
+        """Waits up to timeout for files to arrive, then rescans"""
+        if self._inotify is None:
+            time.sleep(timeout)
+        else:
+            for (directory, mask, name) in self._inotify.read(timeout):
+                path = os.path.join(directory, name)
+                if mask & IN_ISDIR:
+                    if directory == self._dir and name.isdigit():
+                        self._watch(path)
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    self._closed.add(path)
+        self.scan()
+
+    def schedule(self, byte_budget=None):
+        """
+        Files for the next call, most urgent first: by priority, raised a
+        level for every aging seconds waited, then small files ahead of
+        bulk, then oldest first. With a byte budget, files that don't fit
+        are left for a later call
+        """
+        now = time.time()
+
+        def _key(item):
+            (path, entry) = item
+            priority = entry["priority"]
+            if self._aging:
+                priority -= int((now - entry["first_seen"]) // self._aging)
+            return (max(0, priority), entry["size"] > BULK_SIZE,
+                    entry["first_seen"], entry["size"])
+
+        chosen = []
+        total = 0
+        for (path, entry) in sorted(self._queue.items(), key=_key):
+            if byte_budget is not None and chosen and \
+                    total + entry["size"] > byte_budget:
+                continue
+            chosen.append(path)
+            total += entry["size"]
+        return chosen
+
+    def size(self, paths):
+        """Bytes waiting in the given files"""
+        return sum(self._queue[path]["size"] for path in paths
+                   if path in self._queue)
+
+    def mark_sent(self, path):
+        target = os.path.join(self._sent, os.path.basename(path))
+        if os.path.exists(target):
+            target = "{}.{}".format(target, int(time.time()))
+
+        os.replace(path, target)
+        self._queue.pop(path, None)
+        self._closed.discard(path)
+        self._save()
+        logging.info("Sent {}, moved to {}".format(path, target))
+
+    def __len__(self):
+        return len(self._queue)
+
+
+class SpoolException(Exception):
+    pass
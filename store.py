@@ -0,0 +1,582 @@
+import binascii
+import errno
+import logging
+import os
+import queue
+import tempfile
+
+from journal import Journal
+from protocol import PAD, ChunkDigest, file_digest
+from threading import Condition, Lock, Thread
+
+JOURNAL_FILE = ".journal.db"
+
+
+def chunk_digest(path, block_size=65536):
+    """
+    Length and CRC32 of a chunk file, ignoring the trailing XMODEM padding
+    so the sender can compare it against the chunk it holds
+    """
+    length = 0
+    crc = 0
+    last = b""
+
+    with open(path, "rb") as fh:
+        block = fh.read(block_size)
+        while block:
+            if last:
+                crc = binascii.crc32(last, crc)
+                length += len(last)
+            last = block
+            block = fh.read(block_size)
+
+    last = last.rstrip(PAD)
+    return length + len(last), binascii.crc32(last, crc) & 0xffffffff
+
+
+def _fsync_dir(directory):
+    # So a rename into it survives a crash as well as the file's data
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class DigestWriter(object):
+    """
+    Passes writes through to a file, keeping the same length and CRC32 as
+    chunk_digest would give for it afterwards without reading it back, and
+    the strong digest the sender puts in the preamble. Given the chunk's
+    length, the digests are of exactly that much, as the sender's are
+    """
+
+    def __init__(self, target, length=None):
+        self._target = target
+        self._digest = ChunkDigest(length)
+
+    def write(self, data):
+        self._target.write(data)
+        self._digest.update(data)
+        return len(data)
+
+    def flush(self):
+        self._target.flush()
+
+    @property
+    def digest(self):
+        return self._digest.digest
+
+    @property
+    def strong(self):
+        return self._digest.strong
+
+
+def copy_range(src, dst, length, block_size=1048576):
+    """
+    Copy length bytes from the current offset of src to dst, keeping the
+    data in the kernel where possible and memory bounded by block_size
+    otherwise
+    """
+    copied = 0
+    copy = getattr(os, "copy_file_range", None)
+
+    while copied < length:
+        count = min(block_size, length - copied)
+        n = 0
+
+        if copy is not None:
+            try:
+                n = copy(src, dst, count)
+            except OSError:
+                copy = None
+                continue
+        else:
+            try:
+                n = os.sendfile(dst, src, None, count)
+            except OSError:
+                n = os.write(dst, os.read(src, count))
+
+        if not n:
+            break
+        copied += n
+
+    return copied
+
+
+class OffsetWriter(object):
+    """
+    Writes a chunk straight into its place in the file being received.
+    The writes go to a thread of their own so the disk never holds up the
+    transfer, anything past the chunk's end, like XMODEM padding, is
+    dropped, and it is all on disk once closed
+    """
+
+    def __init__(self, path, offset, length, queue_size=64):
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+        self._pos = offset
+        self._end = offset + length
+        self._error = None
+        self._queue = queue.Queue(queue_size)
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is not None:
+                continue
+
+            (offset, data) = item
+            try:
+                while data:
+                    written = os.pwrite(self._fd, data, offset)
+                    offset += written
+                    data = data[written:]
+            except OSError as e:
+                self._error = e
+
+    def write(self, data):
+        if self._error is not None:
+            raise self._error
+
+        count = min(len(data), max(0, self._end - self._pos))
+        if count:
+            self._queue.put((self._pos, bytes(data[:count])))
+            self._pos += count
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._fd is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        try:
+            if self._error is None:
+                os.fsync(self._fd)
+        finally:
+            os.close(self._fd)
+            self._fd = None
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class NullWriter(object):
+    """Takes a chunk that isn't needed, like one of a published file"""
+
+    def write(self, data):
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ChunkStore(object):
+    """
+    Incoming files, written straight into <name>.part at each chunk's
+    offset when the sender gives it, or kept as <name>.<chunk> chunk files
+    to be copied in when it doesn't. A chunk only counts once it is
+    recorded in the journal, which answers what is held without looking
+    at the files. Once published a file is never written into again
+    """
+
+    def __init__(self, directory):
+        self._dir = directory
+        self._journal = Journal(os.path.join(self._dir, JOURNAL_FILE))
+        self._lock = Lock()
+        # Chunks opened and not yet committed or discarded, as (file,
+        # chunk, partial), which hold up publishing their file
+        self._open = set()
+        self._publishing = set()
+        self._published = Condition(self._lock)
+
+    @staticmethod
+    def _name(filename):
+        if isinstance(filename, bytes):
+            filename = filename.decode()
+        return os.path.basename(filename)
+
+    def _key(self, filename, file_length, total_chunks):
+        return (self._name(filename), file_length, total_chunks)
+
+    def file_path(self, filename):
+        return os.path.join(self._dir, self._name(filename))
+
+    def chunk_path(self, filename, chunk, partial=False):
+        """
+        Where a chunk is kept, or received to if partial. partial may tag
+        the path, so that a chunk sent again over another connection
+        doesn't land on top of one still arriving
+        """
+        path = "{}.{}".format(self.file_path(filename), chunk)
+        if partial is True:
+            return "{}.part".format(path)
+        return "{}.{}.part".format(path, partial) if partial else path
+
+    def part_path(self, filename):
+        return "{}.part".format(self.file_path(filename))
+
+    def _open_part(self, filename, file_length, total_chunks):
+        """
+        The file chunks are written into, preallocated so running out of
+        space shows up before the transfer rather than during it
+        """
+        path = self.part_path(filename)
+        if os.path.exists(path):
+            return path
+
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            allocate = getattr(os, "posix_fallocate", None)
+            try:
+                if allocate is None:
+                    raise OSError(errno.EOPNOTSUPP, "No fallocate")
+                allocate(fd, 0, file_length)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    raise
+                os.ftruncate(fd, file_length)
+        finally:
+            os.close(fd)
+        return path
+
+    def open_chunk(self, filename, file_length, total_chunks, chunk,
+                   offset=None, length=None, partial=True, whole=None):
+        """
+        Where to write a chunk as it arrives: its place in the file when
+        offset and length are known, or otherwise a chunk file, at the
+        chunk_path given by partial. Every chunk opened has to be
+        committed or discarded before its file is published.
+
+        A chunk of a file already published is dropped, unless whole, the
+        digest of the file, says it's a new version, which starts over
+        """
+        if offset is not None and (offset < 0 or length < 0 or
+                                   offset + length > file_length):
+            raise StoreException("Chunk {} of {} at {} for {} bytes is "
+                                 "outside the file".format(
+                                     chunk, filename, offset, length))
+
+        key = self._key(filename, file_length, total_chunks)
+        with self._lock:
+            while key in self._publishing:
+                self._published.wait()
+
+            if self._journal.is_complete(*key):
+                if whole is not None and \
+                        whole == self._journal.digests(*key)[0]:
+                    logging.info("{} is already published, dropping chunk "
+                                 "{}".format(key[0], chunk))
+                    return NullWriter()
+
+                logging.info("Receiving a new version of {}".format(key[0]))
+                self._journal.forget(*key)
+                self._journal.reopen(*key)
+                if os.path.exists(self.part_path(filename)):
+                    os.unlink(self.part_path(filename))
+
+            path = self._open_part(filename, file_length, total_chunks)
+            self._open.add((key, chunk, partial))
+
+        try:
+            if offset is None:
+                return open(self.chunk_path(filename, chunk,
+                                            partial=partial), "wb")
+            return OffsetWriter(path, offset, length)
+        except OSError:
+            self._close(key, chunk, partial)
+            raise
+
+    def _close(self, key, chunk, partial):
+        with self._lock:
+            self._open.discard((key, chunk, partial))
+
+    def _is_open(self, key, chunk, partial):
+        with self._lock:
+            return (key, chunk, partial) in self._open
+
+    def commit_chunk(self, filename, file_length, total_chunks, chunk,
+                     digest=None, strong=None, whole=None, partial=True,
+                     offset=None):
+        """
+        Records a received chunk: digest is its (length, crc32), strong and
+        whole the digests of it and of the file, if the sender gave them.
+        A chunk written into place is at offset, otherwise it's a chunk
+        file
+        """
+        key = self._key(filename, file_length, total_chunks)
+        if not self._is_open(key, chunk, partial):
+            return
+
+        try:
+            if offset is None:
+                path = self.chunk_path(filename, chunk)
+                os.replace(self.chunk_path(filename, chunk, partial=partial),
+                           path)
+                (length, crc) = digest or chunk_digest(path)
+            else:
+                (length, crc) = digest
+
+            self._journal.commit_chunk(key[0], file_length, total_chunks,
+                                       chunk, length, crc, offset=offset,
+                                       digest=strong, file_digest=whole)
+        finally:
+            self._close(key, chunk, partial)
+
+    def discard_chunk(self, filename, file_length, total_chunks, chunk,
+                      partial=True, offset=None):
+        """
+        Throws away a chunk that failed. One written into place may have
+        overwritten a copy held from before, which then goes too
+        """
+        key = self._key(filename, file_length, total_chunks)
+        if not self._is_open(key, chunk, partial):
+            return
+
+        try:
+            if offset is None:
+                path = self.chunk_path(filename, chunk, partial=partial)
+                if os.path.exists(path):
+                    os.unlink(path)
+            else:
+                self._journal.forget(key[0], file_length, total_chunks,
+                                     chunk=chunk)
+        finally:
+            self._close(key, chunk, partial)
+
+    def store_inline(self, filename, file_length, data):
+        """
+        Writes a file that came whole inside its preamble straight into
+        place, there being no chunks to reassemble. Refused while chunks
+        of a file by the same name are being received, and on disk before
+        the journal has it complete
+        """
+        if len(data) != file_length:
+            raise StoreException("Got {} bytes inline for {}, expected "
+                                 "{}".format(len(data), filename,
+                                             file_length))
+
+        name = self._name(filename)
+        path = self.file_path(filename)
+        with self._lock:
+            if any(key[0] == name for key in self._publishing) or \
+                    any(key[0] == name for (key, _, _) in self._open):
+                raise StoreException("Chunks of {} are being received, not "
+                                     "storing it inline".format(name))
+
+            # A name of its own, <name>.part being where chunks go
+            (fd, partial) = tempfile.mkstemp(prefix=".{}.".format(name),
+                                             suffix=".part", dir=self._dir)
+            try:
+                with os.fdopen(fd, "wb") as fh:
+                    os.fchmod(fh.fileno(), 0o644)
+                    digest = DigestWriter(fh, file_length)
+                    digest.write(data)
+                    fh.flush()
+                    os.fsync(fh.fileno())
+                os.replace(partial, path)
+            except BaseException:
+                if os.path.exists(partial):
+                    os.unlink(partial)
+                raise
+            _fsync_dir(self._dir)
+
+            (length, crc) = digest.digest
+            self._journal.commit_chunk(name, file_length, 1, 1, length, crc)
+            self._journal.complete(name, file_length, 1)
+        logging.info("Stored {} inline, {} bytes".format(path, file_length))
+        return path
+
+    def held_chunks(self, filename, file_length, total_chunks, whole=None):
+        """
+        The chunks held of a file. A published file isn't written into
+        again, so all of it is held if whole, the digest of the file,
+        says it's the same one, and a new version has to come whole
+        """
+        key = self._key(filename, file_length, total_chunks)
+        held = {}
+        if not self._journal.is_complete(*key) or \
+                (whole is not None and
+                 whole == self._journal.digests(*key)[0]):
+            held = self._journal.chunks(*key)
+        logging.debug("Holding chunks {} of {}".format(
+            ",".join([str(c) for c in sorted(held)]) or "none",
+            self._name(filename)))
+        return held
+
+    def has_all_chunks(self, filename, file_length, total_chunks):
+        return self._journal.chunk_count(self._name(filename), file_length,
+                                         total_chunks) == total_chunks
+
+    def verify(self, filename, file_length, total_chunks):
+        """
+        Checks the chunks held against the digest the sender gave for the
+        whole file, from their own digests so nothing is read back. False
+        if they don't match, when the chunks are forgotten so they're sent
+        again, or None if there's nothing to check against
+        """
+        (expected, chunks) = self._journal.digests(
+            self._name(filename), file_length, total_chunks)
+        ordered = [chunks.get(i) for i in range(1, total_chunks + 1)]
+        if expected is None or None in ordered:
+            return None
+
+        if file_digest(ordered) != expected:
+            self._journal.forget(self._name(filename), file_length,
+                                 total_chunks)
+            return False
+        return True
+
+    def unassembled(self):
+        """Files that were complete but not reassembled when we stopped"""
+        return self._journal.unfinished()
+
+    def assemble(self, filename, file_length, total_chunks):
+        """
+        Publish a file once all its chunks are held, copying in any that
+        came as chunk files and trimming the XMODEM padding. Only done once
+        it checks out, by renaming it over the top, and not while chunks
+        are still being received into it. Whoever commits the last of
+        those asks again
+        """
+        key = self._key(filename, file_length, total_chunks)
+        path = self.file_path(filename)
+
+        with self._lock:
+            if self._journal.is_complete(*key):
+                return path
+            if any(k == key for (k, _, _) in self._open):
+                logging.info("Chunks of {} are still arriving, publishing "
+                             "once they're done".format(path))
+                return None
+            self._publishing.add(key)
+
+        try:
+            return self._publish(filename, file_length, total_chunks)
+        finally:
+            with self._lock:
+                self._publishing.discard(key)
+                self._published.notify_all()
+
+    def _publish(self, filename, file_length, total_chunks):
+        name = self._name(filename)
+        path = self.file_path(filename)
+        partial = self.part_path(filename)
+
+        if self.verify(filename, file_length, total_chunks) is False:
+            raise StoreException("Chunks of {} don't match its digest, "
+                                 "they'll need sending again".format(path))
+
+        offsets = self._journal.offsets(name, file_length, total_chunks)
+        lengths = self._journal.chunks(name, file_length, total_chunks)
+        chunk_files = []
+        position = 0
+
+        fd = os.open(partial, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            for i in range(1, total_chunks + 1):
+                # Chunks written into place are already there
+                if offsets.get(i) is not None:
+                    position = offsets[i] + lengths[i][0]
+                    continue
+
+                chunk_file = self.chunk_path(filename, i)
+                if not os.path.exists(chunk_file):
+                    self._journal.forget(name, file_length, total_chunks,
+                                         chunk=i)
+                    raise StoreException("Chunk file {} has gone, it'll "
+                                         "need sending again".format(
+                                             chunk_file))
+
+                chunk_length = os.stat(chunk_file).st_size
+                read_length = min(chunk_length, file_length - position)
+                logging.debug("Writing {} of {} bytes from chunk {} to {}".format(
+                    read_length, chunk_length, chunk_file, path))
+
+                os.lseek(fd, position, os.SEEK_SET)
+                with open(chunk_file, "rb") as rfh:
+                    position += copy_range(rfh.fileno(), fd, read_length)
+                chunk_files.append(chunk_file)
+
+                if position < file_length and i == total_chunks:
+                    raise StoreException(
+                        "Reassembled {} bytes of {}, expected {}".format(
+                            position, path, file_length))
+
+            os.ftruncate(fd, file_length)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        os.replace(partial, path)
+        self._journal.complete(name, file_length, total_chunks)
+        for chunk_file in chunk_files:
+            os.unlink(chunk_file)
+        logging.info("Published {} from {} chunks, {} copied in, {} "
+                     "bytes".format(path, total_chunks, len(chunk_files),
+                                    file_length))
+        return path
+
+
+class Assembler(object):
+    """Reassembles completed files on a worker so receiving can carry on"""
+
+    def __init__(self, store):
+        self._store = store
+        self._queue = queue.Queue()
+        # Chunks of one file can finish on several connections at once
+        self._lock = Lock()
+        self._queued = set()
+        self._thread = Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def submit(self, filename, file_length, total_chunks):
+        key = (self._store._name(filename), file_length, total_chunks)
+        with self._lock:
+            if key in self._queued:
+                return
+            self._queued.add(key)
+        self._queue.put((filename, file_length, total_chunks))
+
+    def run(self):
+        while True:
+            (filename, file_length, total_chunks) = self._queue.get()
+            # Taken off before it runs, so that a chunk committed while the
+            # file waits on others submits it again
+            with self._lock:
+                self._queued.discard((self._store._name(filename),
+                                      file_length, total_chunks))
+
+            try:
+                self._store.assemble(filename, file_length, total_chunks)
+            except (OSError, StoreException):
+                logging.exception("Could not reassemble {}".format(filename))
+            finally:
+                self._queue.task_done()
+
+    def join(self):
+        self._queue.join()
+
+
+class StoreException(Exception):
+    pass
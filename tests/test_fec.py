@@ -0,0 +1,53 @@
+import itertools
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fec
+
+
+def _group(k, size=64, seed=0):
+    rand = random.Random(seed)
+    return [bytes(rand.randrange(256) for _ in range(size))
+            for _ in range(k)]
+
+
+class DecodeTest(unittest.TestCase):
+    def _check(self, k, parity, lost):
+        data = _group(k, seed=k * 31 + parity)
+        blocks = dict(enumerate(data + fec.encode(data, parity)))
+        for index in lost:
+            del blocks[index]
+        self.assertEqual(fec.decode(k, blocks), data)
+
+    def test_nothing_lost(self):
+        self._check(8, 2, [])
+
+    def test_every_erasure_pattern(self):
+        # Any parity of the k + parity blocks can go, data or parity
+        for k, parity in ((4, 1), (4, 3), (6, 2)):
+            for count in range(parity + 1):
+                for lost in itertools.combinations(range(k + parity), count):
+                    self._check(k, parity, lost)
+
+    def test_large_group(self):
+        self._check(200, 8, [0, 17, 50, 99, 150, 199, 201, 207])
+
+    def test_too_many_lost(self):
+        data = _group(6)
+        blocks = dict(enumerate(data + fec.encode(data, 2)))
+        for index in (1, 3, 6):
+            del blocks[index]
+        with self.assertRaises(fec.FECException):
+            fec.decode(6, blocks)
+
+    def test_group_too_large(self):
+        with self.assertRaises(fec.FECException):
+            fec.encode(_group(250, size=4), 8)
+
+
+if __name__ == "__main__":
+    unittest.main()
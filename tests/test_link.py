@@ -0,0 +1,79 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from link import LinkController
+
+
+def _controller(rtt=1.5, history=(), windowed=False):
+    # history is (block size, blocks that went, blocks that failed) for
+    # each transfer, as their callbacks report them
+    controller = LinkController(240, rtt=rtt)
+    for (block_size, success_count, error_count) in history:
+        controller.transferred(block_size * success_count, block_size,
+                               success_count, error_count,
+                               windowed=windowed, rtt=rtt)
+    return controller
+
+
+class BlockSizeTest(unittest.TestCase):
+    def test_fresh(self):
+        controller = _controller()
+        self.assertEqual(controller.block_size(), 1024)
+        self.assertEqual(controller.block_size(windowed=True), 1024)
+
+    def test_poor_signal(self):
+        # XMODEM waits out the round trip for every block whatever its
+        # size, so it holds on to big blocks far longer than a window
+        controller = _controller()
+        controller.signal(0)
+        self.assertEqual(controller.block_size(), 1024)
+        self.assertEqual(controller.block_size(windowed=True), 128)
+
+    def test_errors(self):
+        controller = _controller(history=[(1024, 50, 50)])
+        self.assertEqual(controller.block_size(), 1024)
+        self.assertEqual(controller.block_size(windowed=True), 128)
+
+        controller.transferred(128 * 50, 128, 50, 150)
+        self.assertEqual(controller.block_size(), 128)
+        self.assertEqual(controller.block_size(windowed=True), 128)
+
+    def test_errors_forgotten(self):
+        controller = _controller(history=[(128, 50, 150)] +
+                                 [(1024, 200, 0)] * 3)
+        self.assertEqual(controller.block_size(), 1024)
+        self.assertEqual(controller.block_size(windowed=True), 1024)
+
+    def test_window_waiting_on_round_trip(self):
+        # Too long a round trip for a window of small blocks to cover, so
+        # fewer bigger blocks win at an error rate that would favour 128
+        history = [(1024, 150, 50)]
+        self.assertEqual(_controller(history=history, windowed=True).
+                         block_size(windowed=True), 128)
+        self.assertEqual(_controller(rtt=60, history=history, windowed=True).
+                         block_size(windowed=True), 1024)
+
+
+class MinParityTest(unittest.TestCase):
+    def test_clean(self):
+        controller = _controller(history=[(1024, 500, 0)], windowed=True)
+        self.assertEqual(controller.min_parity, 0)
+
+    def test_signal(self):
+        controller = _controller()
+        self.assertEqual(controller.min_parity, 1)
+        controller.signal(4)
+        controller.signal(5)
+        self.assertEqual(controller.min_parity, 0)
+
+    def test_lossy(self):
+        controller = _controller(history=[(1024, 500, 0), (1024, 90, 10)],
+                                 windowed=True)
+        self.assertEqual(controller.min_parity, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
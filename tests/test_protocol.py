@@ -0,0 +1,165 @@
+import binascii
+import hashlib
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from protocol import CAP_1K, CAP_WINDOW, DIGEST_SIZE, FILENAME, NEGOTIATE, \
+    PAD, STARTXFER, WAKE, ChunkDigest, Filename, InvalidMessage, \
+    Negotiate, Parser, Preamble, StartTransfer, Wake, pack_pipelined, \
+    pack_preamble
+
+
+def _digests(data, length=None, block_size=128):
+    digest = ChunkDigest(length)
+    for start in range(0, len(data), block_size):
+        digest.update(data[start:start + block_size])
+    return digest.digest, digest.strong
+
+
+class ChunkDigestTest(unittest.TestCase):
+    # A chunk whose data really ends in what XMODEM pads with
+    DATA = b"chunk data" * 30 + PAD * 5
+
+    def test_known_length_keeps_trailing_pad(self):
+        expected = ((len(self.DATA), binascii.crc32(self.DATA)),
+                    hashlib.blake2b(self.DATA,
+                                    digest_size=DIGEST_SIZE).digest())
+        self.assertEqual(_digests(self.DATA, len(self.DATA)), expected)
+
+    def test_known_length_ignores_block_padding(self):
+        padded = self.DATA + PAD * (-len(self.DATA) % 128)
+        self.assertEqual(_digests(padded, len(self.DATA)),
+                         _digests(self.DATA, len(self.DATA)))
+
+    def test_short_data_counts_what_arrived(self):
+        (length, _), _ = _digests(self.DATA[:-1], len(self.DATA))
+        self.assertEqual(length, len(self.DATA) - 1)
+
+    def test_no_length_strips_trailing_pad(self):
+        self.assertEqual(_digests(self.DATA + PAD * 50),
+                         _digests(self.DATA.rstrip(PAD),
+                                  len(self.DATA.rstrip(PAD))))
+
+    def test_no_length_keeps_pad_followed_by_data(self):
+        data = PAD * 3 + b"x"
+        (length, crc), _ = _digests(data, block_size=1)
+        self.assertEqual((length, crc), (4, binascii.crc32(data)))
+
+
+def _feed(parser, data, sizes):
+    # data fed in pieces of the given sizes in turn, the last one repeating
+    messages = []
+    start = 0
+    for count in range(len(data)):
+        size = sizes[min(count, len(sizes) - 1)]
+        messages += parser.feed(data[start:start + size])
+        start += size
+        if start >= len(data):
+            break
+    return messages
+
+
+class ParserTest(unittest.TestCase):
+    PREAMBLE = pack_preamble(b"data.bin", 5000, 2, 3,
+                             digests=(b"c" * DIGEST_SIZE, b"f" * DIGEST_SIZE),
+                             chunk_range=(1024, 2048))
+    HANDSHAKE = bytes([WAKE, NEGOTIATE, CAP_1K | CAP_WINDOW]) + PREAMBLE + \
+        bytes([STARTXFER])
+
+    def _check_handshake(self, parser, messages):
+        self.assertEqual([type(message) for message in messages],
+                         [Wake, Negotiate, Preamble, StartTransfer])
+        self.assertEqual(messages[1], Negotiate(CAP_1K | CAP_WINDOW, False))
+        preamble = messages[2]
+        self.assertEqual((preamble.filename, preamble.file_length,
+                          preamble.chunk, preamble.total_chunks),
+                         (b"data.bin", 5000, 2, 3))
+        self.assertEqual((preamble.digest, preamble.file_digest),
+                         (b"c" * DIGEST_SIZE, b"f" * DIGEST_SIZE))
+        self.assertEqual((preamble.offset, preamble.length), (1024, 2048))
+        self.assertTrue(parser.transferring)
+
+    def test_whole(self):
+        parser = Parser()
+        messages = parser.feed(self.HANDSHAKE + b"\x02block")
+        self._check_handshake(parser, messages)
+        self.assertEqual(parser.take(), b"\x02block")
+
+    def test_byte_at_a_time(self):
+        parser = Parser()
+        messages = _feed(parser, self.HANDSHAKE + b"\x02block", [1])
+        self._check_handshake(parser, messages)
+        self.assertEqual(parser.take(), b"\x02block")
+
+    def test_odd_splits(self):
+        data = self.HANDSHAKE + b"\x02block"
+        for sizes in ([2, 7], [3], [5, 1, 13], [len(self.PREAMBLE) - 1]):
+            parser = Parser()
+            messages = _feed(parser, data, sizes)
+            self._check_handshake(parser, messages)
+            self.assertEqual(parser.take(), b"\x02block")
+
+    def test_stops_at_transfer(self):
+        # Bytes after STARTXFER are the transfer's, even ones that look
+        # like commands
+        parser = Parser()
+        parser.feed(self.HANDSHAKE)
+        self.assertEqual(parser.feed(bytes([WAKE, FILENAME])), [])
+        self.assertEqual(parser.take(), bytes([WAKE, FILENAME]))
+
+        parser.reset()
+        self.assertFalse(parser.transferring)
+        self.assertEqual(parser.feed(bytes([WAKE])), [Wake()])
+
+    def test_pipelined(self):
+        preamble = pack_preamble(b"data.bin", 300)
+        data = pack_pipelined(CAP_1K, preamble) + b"\x01block"
+        parser = Parser()
+        messages = _feed(parser, data, [4, 1])
+        self.assertEqual([type(message) for message in messages],
+                         [Negotiate, Preamble])
+        self.assertTrue(messages[0].pipelined)
+        self.assertTrue(parser.transferring)
+        self.assertEqual(parser.take(), b"\x01block")
+
+    def test_inline(self):
+        # Inline data is the whole file, so the parser carries on with the
+        # next command rather than starting a transfer
+        payload = bytes(range(256)) * 3
+        data = bytes([FILENAME]) + pack_preamble(b"small", len(payload),
+                                                 data=payload) + \
+            bytes([WAKE])
+        parser = Parser()
+        messages = _feed(parser, data, [100, 3])
+        self.assertEqual([type(message) for message in messages],
+                         [Filename, Preamble, Wake])
+        self.assertTrue(messages[1].inline)
+        self.assertEqual(messages[1].data, payload)
+        self.assertFalse(parser.transferring)
+
+    def test_corrupt_inline(self):
+        payload = b"inline data"
+        preamble = bytearray(pack_preamble(b"small", len(payload),
+                                           data=payload))
+        preamble[-1] ^= 0xff
+        parser = Parser()
+        messages = _feed(parser, bytes([FILENAME]) + preamble, [2])
+        self.assertEqual([type(message) for message in messages],
+                         [Filename, InvalidMessage])
+        self.assertFalse(parser.transferring)
+
+    def test_wake_restarts(self):
+        # A sender that gave up waiting for us starts over from the wake
+        # up, before the preamble it was asked for
+        parser = Parser()
+        data = bytes([FILENAME]) + self.HANDSHAKE
+        messages = _feed(parser, data, [6])
+        self.assertEqual(type(messages[0]), Filename)
+        self._check_handshake(parser, messages[1:])
+
+
+if __name__ == "__main__":
+    unittest.main()
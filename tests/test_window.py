@@ -0,0 +1,116 @@
+import io
+import os
+import random
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from window import FRAME_ACK, FRAME_DATA, FRAME_END_ACK, FRAME_START, \
+    SlidingWindow
+
+
+class Pipe(object):
+    """
+    One direction of an in-memory line. Each putc is a whole frame, and
+    frames the given check picks are lost or have a byte flipped
+    """
+
+    def __init__(self, seed, drop=0.0, corrupt=0.0, spare=(), limit=None):
+        self._buffer = bytearray()
+        self._cond = threading.Condition()
+        self._rand = random.Random(seed)
+        self._drop = drop
+        self._corrupt = corrupt
+        self._spare = spare
+        self._limit = limit
+        self.damaged = 0
+
+    def putc(self, data, timeout=1):
+        if data[0] not in self._spare and self.damaged != self._limit:
+            if self._rand.random() < self._drop:
+                self.damaged += 1
+                return len(data)
+            if self._rand.random() < self._corrupt:
+                self.damaged += 1
+                data = bytearray(data)
+                data[self._rand.randrange(len(data))] ^= 0x55
+        with self._cond:
+            self._buffer += data
+            self._cond.notify_all()
+        return len(data)
+
+    def getc(self, size, timeout=1):
+        with self._cond:
+            self._cond.wait_for(lambda: self._buffer, timeout)
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+        return data or None
+
+
+def _transfer(data, forward, back, block_size=128, fec_group=0, retry=10):
+    sender = SlidingWindow(back.getc, forward.putc, block_size=block_size,
+                           rate=100000, start_timeout=1, fec_group=fec_group)
+    receiver = SlidingWindow(forward.getc, back.putc)
+    stream = io.BytesIO()
+    received = []
+
+    thread = threading.Thread(
+        target=lambda: received.append(receiver.recv(stream, timeout=1)))
+    thread.start()
+    sent = sender.send(io.BytesIO(data), retry=retry)
+    thread.join()
+    return sent, received[0], stream.getvalue()
+
+
+class SlidingWindowTest(unittest.TestCase):
+    DATA = bytes(random.Random(1).randrange(256) for _ in range(24 * 128))
+
+    def test_clean(self):
+        self.assertEqual(_transfer(self.DATA, Pipe(0), Pipe(0)),
+                         (True, len(self.DATA), self.DATA))
+
+    def test_short_last_block(self):
+        data = self.DATA[:1000]
+        self.assertEqual(_transfer(data, Pipe(0), Pipe(0)),
+                         (True, len(data), data))
+
+    def test_lossy(self):
+        # A lost acknowledgement of the end leaves the sender reporting a
+        # failure for a file that arrived, that's covered on its own below
+        for seed in range(2):
+            forward = Pipe(seed, drop=0.05, corrupt=0.05)
+            back = Pipe(seed + 100, drop=0.05, corrupt=0.05,
+                        spare=(FRAME_END_ACK,))
+            self.assertEqual(_transfer(self.DATA, forward, back),
+                             (True, len(self.DATA), self.DATA))
+            self.assertTrue(forward.damaged)
+
+    def test_lossy_fec(self):
+        forward = Pipe(7, drop=0.1, corrupt=0.05)
+        back = Pipe(8, drop=0.05, spare=(FRAME_END_ACK,))
+        self.assertEqual(_transfer(self.DATA, forward, back, fec_group=8),
+                         (True, len(self.DATA), self.DATA))
+
+    def test_end_corrupted(self):
+        # The end only counts once the receiver says it has everything
+        forward = Pipe(0, corrupt=1.0, spare=(FRAME_START, FRAME_DATA),
+                       limit=3)
+        self.assertEqual(_transfer(self.DATA, forward, Pipe(0)),
+                         (True, len(self.DATA), self.DATA))
+
+    def test_end_never_acknowledged(self):
+        # Every acknowledgement of the end lost: the data arrived but the
+        # sender can't know, so it mustn't report success
+        start = time.monotonic()
+        back = Pipe(0, drop=1.0, spare=(FRAME_ACK,))
+        sent, received, data = _transfer(self.DATA, Pipe(0), back, retry=3)
+        self.assertFalse(sent)
+        self.assertEqual((received, data), (len(self.DATA), self.DATA))
+        self.assertLess(time.monotonic() - start, 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
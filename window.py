@@ -0,0 +1,500 @@
+import binascii
+import fec
+import logging
+import math
+import struct
+import time
+
+FRAME_START = 0xf1
+FRAME_DATA = 0xf2
+FRAME_END = 0xf3
+FRAME_ACK = 0xf4
+FRAME_START_FEC = 0xf5
+FRAME_PARITY = 0xf6
+FRAME_ACK_FEC = 0xf7
+FRAME_END_ACK = 0xf8
+
+# Every frame is followed by a CRC32 of everything before it in the frame.
+# Data frames also carry the complement of their length, so a corrupted
+# length is caught before we wait on a payload that never arrives
+START = struct.Struct("<BHB")
+DATA = struct.Struct("<BIHH")
+END = struct.Struct("<BIQ")
+ACK = struct.Struct("<BII")
+CRC = struct.Struct("<I")
+
+# Only the end being acknowledged finishes a transfer, as an ordinary
+# acknowledgement of every block can be old or answer a corrupted end
+END_ACK = struct.Struct("<BI")
+
+# With forward error correction the start gives the group size, every
+# group of data blocks is followed by parity blocks over them, and the
+# acknowledgements also count the blocks seen and lost so the sender can
+# size the parity to the link. Blocks are coded with their length in front
+# and padded to the block size
+START_FEC = struct.Struct("<BHBB")
+PARITY = struct.Struct("<BIBBHH")
+ACK_FEC = struct.Struct("<BIIII")
+FEC_LENGTH = struct.Struct("<H")
+
+HEADERS = {
+    FRAME_START: START,
+    FRAME_DATA: DATA,
+    FRAME_END: END,
+    FRAME_ACK: ACK,
+    FRAME_START_FEC: START_FEC,
+    FRAME_PARITY: PARITY,
+    FRAME_ACK_FEC: ACK_FEC,
+    FRAME_END_ACK: END_ACK,
+}
+
+# Where the payload length and its complement are in the frames with one
+PAYLOADS = {
+    FRAME_DATA: 2,
+    FRAME_PARITY: 4,
+}
+
+# Selective acknowledgements are a bitmap of the blocks after the
+# cumulative acknowledgement, so the window can't outgrow it
+MAX_WINDOW = 32
+
+# Receivers keep delivered blocks this far back to repair a group from
+MAX_GROUP = 64
+
+# How much of the loss estimate survives each block reported on
+LOSS_DECAY = 0.97
+
+
+def _fec_block(payload, block_size):
+    return FEC_LENGTH.pack(len(payload)) + payload + \
+        bytes(block_size - len(payload))
+
+
+def _fec_payload(block):
+    (length,) = FEC_LENGTH.unpack_from(block)
+    if length > len(block) - FEC_LENGTH.size:
+        raise fec.FECException("Repaired block has a bad length")
+    return block[FEC_LENGTH.size:FEC_LENGTH.size + length]
+
+
+class SlidingWindow(object):
+    """
+    Keeps several blocks in flight with selective retransmission instead of
+    XMODEM's stop-and-wait, for links where the round trip is much longer
+    than the time to send a block. Driven through the same getc/putc
+    callbacks as xmodem.XMODEM
+    """
+
+    def __init__(self, getc, putc, block_size=1024, window=MAX_WINDOW,
+                 rate=960, start_timeout=10, fec_group=0, min_parity=1,
+                 max_parity=8, loss=0.0):
+        self.getc = getc
+        self.putc = putc
+        self.block_size = block_size
+        self.max_window = min(window, MAX_WINDOW)
+        self.rate = rate
+        self.start_timeout = start_timeout
+        self.fec_group = min(fec_group, MAX_GROUP)
+        self.min_parity = min_parity
+        self.max_parity = max_parity
+        # Fraction of frames lost, carried between transfers by the caller
+        self.loss = loss
+        self.rtt = None
+        self.log = logging.getLogger('window.SlidingWindow')
+        self._line_free = 0.0
+
+    @staticmethod
+    def _frame(header, *fields, payload=b""):
+        frame = header.pack(*fields) + payload
+        return frame + CRC.pack(binascii.crc32(frame) & 0xffffffff)
+
+    def _put(self, frame):
+        """
+        Sends a frame, returning when it will have gone out on the line
+        after everything queued ahead of it, as putc only buffers it
+        """
+        now = time.monotonic()
+        self._line_free = max(now, self._line_free) + \
+            len(frame) / float(self.rate)
+        self.putc(frame)
+        return self._line_free
+
+    def _read(self, size, deadline):
+        data = bytearray()
+        while len(data) < size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            read = self.getc(size - len(data), remaining)
+            if read:
+                data += read
+        return bytes(data)
+
+    def _read_frame(self, timeout):
+        """
+        Returns the next frame as (kind, fields, payload), False if it was
+        corrupted or None on timeout
+        """
+        deadline = time.monotonic() + timeout
+
+        while True:
+            marker = self._read(1, deadline)
+            if marker is None:
+                return None
+
+            header = HEADERS.get(marker[0])
+            if header is None:
+                self.log.debug('Skipping unexpected byte {:#04x}'.format(marker[0]))
+                continue
+
+            rest = self._read(header.size - 1, deadline)
+            if rest is None:
+                return None
+            fields = header.unpack(marker + rest)
+
+            payload = b""
+            if marker[0] in PAYLOADS:
+                at = PAYLOADS[marker[0]]
+                limit = self.block_size
+                if marker[0] == FRAME_PARITY:
+                    limit += FEC_LENGTH.size
+                if fields[at] ^ 0xffff != fields[at + 1] or \
+                        fields[at] > limit:
+                    self.log.debug('Bad block length {}'.format(fields[at]))
+                    return False
+                payload = self._read(fields[at], deadline)
+                if payload is None:
+                    return None
+
+            crc = self._read(CRC.size, deadline)
+            if crc is None:
+                return None
+
+            if CRC.unpack(crc)[0] != \
+                    binascii.crc32(marker + rest + payload) & 0xffffffff:
+                self.log.debug('CRC failure on frame {:#04x}'.format(marker[0]))
+                return False
+
+            return marker[0], fields[1:], payload
+
+    def _read_ack(self, timeout, kinds=(FRAME_ACK, FRAME_ACK_FEC)):
+        deadline = time.monotonic() + timeout
+
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            frame = self._read_frame(remaining)
+            if frame is None:
+                return None
+            if frame and frame[0] in kinds:
+                return frame[1]
+
+    def _window_for(self, rtt):
+        # Enough blocks to keep the link busy for a round trip, plus the
+        # one being acknowledged
+        blocks = math.ceil(rtt * self.rate / float(self.block_size)) + 1
+        return max(2, min(self.max_window, blocks))
+
+    def _parity_count(self):
+        # Enough parity for twice the loss the receiver reports, so a
+        # group usually repairs without a retransmission
+        count = math.ceil(2 * self.loss * self.fec_group)
+        return max(self.min_parity, min(self.max_parity, count))
+
+    def _send_parity(self, base, group):
+        count = self._parity_count()
+        blocks = [_fec_block(data, self.block_size) for data in group]
+        done = None
+        for (index, block) in enumerate(fec.encode(blocks, count)):
+            done = self._put(self._frame(PARITY, FRAME_PARITY, base,
+                                         len(group), index, len(block),
+                                         len(block) ^ 0xffff,
+                                         payload=block))
+        return done
+
+    def send(self, stream, retry=16, timeout=60, quiet=False, callback=None):
+        if self.fec_group:
+            start = self._frame(START_FEC, FRAME_START_FEC, self.block_size,
+                                self.max_window, self.fec_group)
+        else:
+            start = self._frame(START, FRAME_START, self.block_size,
+                                self.max_window)
+        rtt = None
+        self._line_free = 0.0
+
+        for _ in range(retry):
+            sent_at = self._put(start)
+            ack = self._read_ack(min(timeout, self.start_timeout))
+            if ack is not None and ack[0] == 0:
+                rtt = time.monotonic() - sent_at
+                break
+        if rtt is None:
+            self.log.info('Receiver never acknowledged the start of transfer')
+            return False
+
+        window = self._window_for(rtt)
+        self.rtt = rtt
+        self.log.debug('Measured RTT {:.3f}s, window of {} blocks'.format(
+            rtt, window))
+
+        # The start can include the receiver getting ready, so the first
+        # clean acknowledgement of data replaces it rather than averaging
+        rtt_seeded = False
+
+        frames = {}
+        sent = {}
+        resent = set()
+        base = 0
+        next_seq = 0
+        eof = False
+        errors = 0
+        success_count = 0
+        error_count = 0
+
+        # Blocks of the group being built, and when the parity covering
+        # each block went, as a lost block can be repaired from then
+        group = []
+        covered = {}
+        reported = (0, 0)
+
+        while True:
+            while not eof and next_seq < base + window:
+                data = stream.read(self.block_size)
+                if not data:
+                    eof = True
+                    break
+                frames[next_seq] = self._frame(DATA, FRAME_DATA, next_seq,
+                                               len(data), len(data) ^ 0xffff,
+                                               payload=data)
+                sent[next_seq] = self._put(frames[next_seq])
+                next_seq += 1
+
+                if self.fec_group:
+                    group.append(data)
+                    if len(group) == self.fec_group:
+                        done = self._send_parity(next_seq - len(group), group)
+                        for seq in range(next_seq - len(group), next_seq):
+                            covered[seq] = done
+                        group = []
+
+            if eof and group:
+                done = self._send_parity(next_seq - len(group), group)
+                for seq in range(next_seq - len(group), next_seq):
+                    covered[seq] = done
+                group = []
+
+            if eof and base == next_seq:
+                break
+
+            rto = min(timeout, max(1.0, 2 * rtt +
+                                   window * self.block_size / float(self.rate)))
+            ack = self._read_ack(rto)
+
+            if ack is None:
+                errors += 1
+                error_count += 1
+                if errors > retry:
+                    self.log.info('Too many timeouts waiting for acknowledgement')
+                    return False
+                self.log.debug('Timed out, resending block {}'.format(base))
+                sent[base] = self._put(frames[base])
+                resent.add(base)
+                if callable(callback):
+                    callback(next_seq, success_count, error_count)
+                continue
+
+            errors = 0
+            (acked, sack) = ack[:2]
+            now = time.monotonic()
+
+            if len(ack) > 2:
+                # Loss over the blocks since the last report, smoothed
+                # over the last few dozen blocks
+                (seen, lost) = ack[2:]
+                if seen > reported[0]:
+                    count = seen - reported[0]
+                    sample = min(1.0, (lost - reported[1]) / float(count))
+                    decay = LOSS_DECAY ** count
+                    self.loss = decay * self.loss + (1 - decay) * sample
+                    reported = (seen, lost)
+
+            progress = acked > base
+            if progress:
+                # Only time blocks that went once, a retransmitted block
+                # can't tell which copy was acknowledged
+                if acked - 1 not in resent and acked - 1 in sent:
+                    sample = max(0.0, now - sent[acked - 1])
+                    rtt = 0.875 * rtt + 0.125 * sample \
+                        if rtt_seeded else sample
+                    rtt_seeded = True
+                    window = self._window_for(rtt)
+                    self.rtt = rtt
+                for seq in range(base, min(acked, next_seq)):
+                    frames.pop(seq, None)
+                    sent.pop(seq, None)
+                    covered.pop(seq, None)
+                    resent.discard(seq)
+                    success_count += 1
+                base = acked
+
+            if base < next_seq:
+                # Anything missing below the highest block received has
+                # been lost, as has the first block if the receiver
+                # acknowledges the same place again. An acknowledgement
+                # that moved on says nothing about the blocks after it,
+                # they're left to the timeout. Resend once per round trip
+                # at most from when a block went out on the line, giving
+                # the parity a round trip to repair it
+                highest = base + sack.bit_length()
+                if not progress:
+                    highest = max(base + 1, highest)
+                for seq in range(base, highest):
+                    if seq != base and sack & (1 << (seq - base - 1)):
+                        continue
+                    if seq in frames and \
+                            now - max(sent[seq], covered.get(seq, 0)) > rtt:
+                        sent[seq] = self._put(frames[seq])
+                        resent.add(seq)
+                        error_count += 1
+
+            if callable(callback):
+                callback(next_seq, success_count, error_count)
+
+        end = self._frame(END, FRAME_END, next_seq, 0)
+        for _ in range(retry):
+            self._put(end)
+            ack = self._read_ack(min(timeout, max(1.0, 2 * rtt)),
+                                 kinds=(FRAME_END_ACK,))
+            if ack is not None and ack[0] == next_seq:
+                self.log.info('Transmission successful, {} blocks'.format(next_seq))
+                return True
+
+        self.log.info('Receiver never acknowledged the end of transfer')
+        return False
+
+    def recv(self, stream, retry=16, timeout=60, quiet=False, callback=None):
+        expected = 0
+        pending = {}
+        written = 0
+        errors = 0
+        started = False
+
+        # Forward error correction: delivered blocks kept for repairs,
+        # parity waiting on {base: (count, {index: block})}, and the blocks
+        # seen and lost for the sender. A block is lost if a later one
+        # arrived before it, however it turns up in the end
+        fec_group = 0
+        recent = {}
+        parity = {}
+        highest = -1
+        lost = 0
+        repaired = 0
+
+        def _ack():
+            sack = 0
+            for seq in pending:
+                sack |= 1 << (seq - expected - 1)
+            if fec_group:
+                self.putc(self._frame(ACK_FEC, FRAME_ACK_FEC, expected, sack,
+                                      highest + 1, lost))
+            else:
+                self.putc(self._frame(ACK, FRAME_ACK, expected, sack))
+
+        def _deliver():
+            nonlocal expected, written
+            while expected in pending:
+                payload = pending.pop(expected)
+                stream.write(payload)
+                written += len(payload)
+                if fec_group:
+                    recent[expected] = payload
+                    recent.pop(expected - MAX_GROUP, None)
+                expected += 1
+
+        def _repair(base):
+            (count, blocks) = parity[base]
+            blocks = dict(blocks)
+            missing = []
+            for i in range(count):
+                payload = recent.get(base + i, pending.get(base + i))
+                if payload is None:
+                    missing.append(base + i)
+                else:
+                    blocks[i] = _fec_block(payload, self.block_size)
+
+            if missing and len(blocks) < count:
+                return 0
+            del parity[base]
+
+            if missing:
+                try:
+                    data = fec.decode(count, blocks)
+                    for seq in missing:
+                        pending[seq] = _fec_payload(data[seq - base])
+                except fec.FECException as e:
+                    self.log.debug('Could not repair blocks {}: {}'.format(
+                        missing, e))
+                    return 0
+            return len(missing)
+
+        while True:
+            frame = self._read_frame(timeout)
+
+            if frame is None:
+                errors += 1
+                if errors > retry:
+                    self.log.info('Too many timeouts waiting for blocks')
+                    return None
+                if started:
+                    _ack()
+                continue
+            errors = 0
+
+            if frame is False:
+                # Tell the sender straight away rather than leaving it to
+                # time out
+                if started:
+                    _ack()
+                continue
+
+            (kind, fields, payload) = frame
+
+            if kind in (FRAME_START, FRAME_START_FEC):
+                (block_size, window) = fields[:2]
+                if kind == FRAME_START_FEC:
+                    fec_group = fields[2]
+                self.block_size = block_size
+                started = True
+                _ack()
+            elif kind == FRAME_DATA and started:
+                seq = fields[0]
+                if seq > highest:
+                    lost += seq - highest - 1
+                    highest = seq
+                if expected <= seq <= expected + MAX_WINDOW:
+                    pending[seq] = payload
+                    _deliver()
+                _ack()
+            elif kind == FRAME_PARITY and started and fec_group:
+                (base, count, index) = fields[:3]
+                if base + count > expected:
+                    parity.setdefault(base, (count, {}))[1][count + index] = \
+                        payload
+                    fixed = _repair(base)
+                    if fixed:
+                        repaired += fixed
+                        self.log.debug('Repaired {} blocks from parity'.format(
+                            fixed))
+                        _deliver()
+                        _ack()
+                for old in [b for b in parity if b + parity[b][0] <= expected]:
+                    del parity[old]
+            elif kind == FRAME_END and started:
+                if fields[0] != expected or pending:
+                    _ack()
+                    continue
+                self.putc(self._frame(END_ACK, FRAME_END_ACK, expected))
+                self.log.info('Transmission complete, {} bytes, {} blocks '
+                              'repaired'.format(written, repaired))
+                return written